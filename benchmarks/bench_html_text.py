@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+HTML-to-text micro-benchmark
+Compares the old per-call re.sub/html.unescape path with html_text on a large
+synthetic thread of Mastodon-style status HTML.
+
+    python benchmarks/bench_html_text.py [posts] [repeats]
+"""
+
+import os
+import re
+import sys
+import html
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from html_text import html_to_text  # noqa: E402
+
+BOT_ACCT = "clod"
+MENTION = '<span class="h-card" translate="no"><a href="https://brain.worm.pink/@{0}" class="u-url mention">@<span>{0}</span></a></span>'
+HASHTAG = '<a href="https://brain.worm.pink/tags/{0}" class="mention hashtag" rel="tag">#<span>{0}</span></a>'
+LINK = '<a href="https://example.com/{0}" rel="nofollow noopener" target="_blank"><span class="invisible">https://</span><span class="">example.com/{0}</span></a>'
+WORDS = "wormium gort frank regort sneep wodk &amp; it&#39;s &quot;quoted&quot; the a of to and".split()
+
+
+def make_post(rng):
+    paragraphs = []
+    for _ in range(rng.randint(1, 4)):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(10, 60))]
+        paragraphs.append(" ".join(words) + "<br />" + " ".join(words[:5]))
+    head = MENTION.format(BOT_ACCT) + " " + MENTION.format(rng.choice(["bob", "alice", "wodk"]))
+    tail = HASHTAG.format(rng.choice(WORDS[:6])) + " " + LINK.format(rng.randint(1, 999))
+    return "<p>" + head + " " + "</p><p>".join(paragraphs) + " " + tail + "</p>"
+
+
+def legacy_clean_content(html_content, bot_acct):
+    """The pre-html_text implementation of clean_content."""
+    text = re.sub(r'<[^>]+>', '', html_content)
+    text = html.unescape(text)
+    text = re.sub(rf"@{re.escape(bot_acct)}", '', text, flags=re.IGNORECASE).strip()
+    return text
+
+
+def legacy_tool_content(html_content):
+    """The pre-html_text get_post/get_thread/search_posts path (no unescape)."""
+    return re.sub(r'<[^>]+>', '', html_content)
+
+
+def bench(name, fn, posts, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for post in posts:
+            fn(post)
+        best = min(best, time.perf_counter() - start)
+    per_post = best / len(posts) * 1e6
+    print(f"{name:<32} {best * 1000:9.2f} ms  {per_post:7.2f} us/post")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    rng = random.Random(42)
+    posts = [make_post(rng) for _ in range(count)]
+    size = sum(len(p) for p in posts)
+    print(f"{count} posts, {size / 1024:.0f} KiB of HTML, best of {repeats}\n")
+
+    bench("legacy clean_content", lambda p: legacy_clean_content(p, BOT_ACCT), posts, repeats)
+    bench("html_to_text (bot mentions)", lambda p: html_to_text(p, bot_acct=BOT_ACCT), posts, repeats)
+    bench("legacy tool re.sub", legacy_tool_content, posts, repeats)
+    bench("legacy tool re.sub + unescape", lambda p: html.unescape(legacy_tool_content(p)), posts, repeats)
+    bench("html_to_text", html_to_text, posts, repeats)
+
+    print("\nSample output:")
+    print("  legacy:", legacy_clean_content(posts[0], BOT_ACCT)[:120].replace("\n", "\\n"))
+    print("  new:   ", html_to_text(posts[0], bot_acct=BOT_ACCT)[:120].replace("\n", "\\n"))
+
+
+if __name__ == "__main__":
+    main()
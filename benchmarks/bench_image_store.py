@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Image storage micro-benchmark
+Compares the old decode + PNG re-encode in danbooru.py with prepare_image on
+synthetic photo-like artwork, reporting encode time and upload size.
+
+    python benchmarks/bench_image_store.py [images] [width] [height]
+"""
+
+import os
+import sys
+import time
+import random
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from PIL import Image, ImageDraw, ImageFilter  # noqa: E402
+
+from danbooru import prepare_image  # noqa: E402
+
+
+def make_image(rng, width, height, fmt):
+    """Gradients, shapes and noise: compresses roughly like a drawing, unlike a flat test card."""
+    img = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    draw = ImageDraw.Draw(img)
+    for _ in range(60):
+        x, y = rng.randrange(width), rng.randrange(height)
+        r = rng.randint(10, width // 6)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randrange(256) for _ in range(3)))
+    img = img.filter(ImageFilter.GaussianBlur(3))
+    noise = Image.effect_noise((width, height), 24).convert("RGB")
+    img = Image.blend(img, noise, 0.15)
+    out = BytesIO()
+    img.save(out, fmt, quality=90)
+    return out.getvalue()
+
+
+def legacy_save_as_png(image_data):
+    """The pre-prepare_image path: decode everything, write PNG."""
+    img = Image.open(BytesIO(image_data))
+    out = BytesIO()
+    img.save(out, "PNG")
+    return out.getvalue(), ".png"
+
+
+def bench(name, fn, sources):
+    started = time.perf_counter()
+    sizes = [len(fn(data)[0]) for data in sources]
+    elapsed = time.perf_counter() - started
+    print(f"{name:<16} {elapsed / len(sources) * 1000:8.1f} ms/image  {sum(sizes) / len(sizes) / 1024:8.0f} KiB/image")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    width = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    height = int(sys.argv[3]) if len(sys.argv) > 3 else 2800
+    rng = random.Random(0)
+
+    for fmt in ("JPEG", "WEBP"):
+        sources = [make_image(rng, width, height, fmt) for _ in range(count)]
+        print(f"\n{count} {fmt} images, {width}x{height}, {sum(map(len, sources)) / count / 1024:.0f} KiB/image source")
+        bench("legacy png", legacy_save_as_png, sources)
+        bench("prepare_image", prepare_image, sources)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+TTL Cache
+A small thread-safe LRU cache whose entries expire after a per-entry TTL.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Bounded LRU cache with a time-to-live on every entry."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Returns the cached value, or `default` if missing or expired."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not _MISSING:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl):
+        """Stores `value` for `ttl` seconds, evicting the least recently used entry if full."""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
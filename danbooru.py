@@ -1,28 +1,44 @@
 #!/usr/bin/env python3
 """
 Danbooru Image Updater Script
-This script fetches random yaoi images from Danbooru and updates a local file
-every 30 seconds.
+This script keeps a pool of random yaoi images from Danbooru ready for the bot,
+swapping the oldest one for a fresh image every 30 seconds.
 """
 
 import os
 import time
-import random
-import requests
 from dotenv import load_dotenv
 from PIL import Image
 from io import BytesIO
 import json
+import http_client
+from image_pool import atomic_write, read_manifest, write_manifest
+from post_index import PostIndex
+from tracing import log
 
 # Load environment variables from .env file
 load_dotenv()
 
 # Configuration
-TARGET_FILE = "./image.png"
+POOL_DIR = os.getenv("YAOI_POOL_DIR", "./image_pool")
+POOL_SIZE = int(os.getenv("YAOI_POOL_SIZE", 10))  # images kept ready at once
+MAX_PIXELS = int(os.getenv("YAOI_MAX_PIXELS", 3840 * 2160))  # larger images get downscaled
+MAX_BYTES = int(os.getenv("YAOI_MAX_BYTES", 8 * 1024 * 1024))  # larger files get re-encoded
+# Formats every Mastodon instance accepts as-is, and the extension we store them with
+ACCEPTED_FORMATS = {"JPEG": ".jpg", "PNG": ".png", "GIF": ".gif", "WEBP": ".webp"}
+INDEXED_EXTENSIONS = ("jpg", "png", "gif", "webp")  # Danbooru's file_ext; videos (mp4, webm) and ugoira (zip) never decode
+JPEG_QUALITIES = (85, 75, 65)  # tried in order until the file fits MAX_BYTES
+RETIRE_GRACE = 300  # seconds a swapped-out image stays on disk for uploads already in progress
 UPDATE_INTERVAL = 30  # seconds
 TAGS = "yaoi rating:general"
 MAX_RETRIES = 3
 BACKOFF_TIME = 5  # seconds
+PAGE_SIZE = 200  # Danbooru's maximum posts per request
+INDEX_FILE = os.getenv("DANBOORU_INDEX_FILE", "./danbooru_index.sqlite3")
+INDEX_TARGET_SIZE = int(os.getenv("DANBOORU_INDEX_SIZE", 2000))  # posts to keep in the local index
+INDEX_REFRESH_INTERVAL = 3600  # seconds between checks for newly uploaded posts
+INDEX_PAGES_PER_UPDATE = 3  # bulk pages fetched per cycle at most, so startup isn't one long burst
+REUSE_WINDOW = 86400  # seconds before a used post is as likely to be picked as a new one
 
 # Danbooru API configuration
 # You can optionally set these in your .env file
@@ -30,17 +46,19 @@ API_KEY = os.getenv("DANBOORU_API_KEY")  # Your API key
 USERNAME = os.getenv("DANBOORU_USERNAME")  # Your username
 BASE_URL = "https://danbooru.donmai.us"
 
+index = None  # PostIndex, opened in main()
+
 def get_auth_params():
     """Return authentication parameters if credentials are provided"""
     if USERNAME and API_KEY:
         return {"login": USERNAME, "api_key": API_KEY}
     return {}
 
-def fetch_image_urls(page=1):
-    """Fetch a list of image URLs matching the tags"""
+def fetch_posts(page):
+    """Fetch one page of posts matching the tags. `page` may be a number or b<id>/a<id>."""
     params = {
         "tags": TAGS,
-        "limit": 20,  # Request multiple posts to pick a random one
+        "limit": PAGE_SIZE,
         "page": page,
     }
     params.update(get_auth_params())
@@ -48,104 +66,227 @@ def fetch_image_urls(page=1):
     url = f"{BASE_URL}/posts.json"
 
     try:
-        response = requests.get(url, params=params)
+        response = http_client.session.get(url, params=params)
 
         if response.status_code == 200:
-            posts = response.json()
-            # Filter posts that have a file URL
-            valid_posts = [post for post in posts if 'file_url' in post]
-            return valid_posts
+            return response.json()
         else:
-            print(f"API request failed: HTTP {response.status_code}")
-            print(f"Response: {response.text}")
+            log(f"API request failed: HTTP {response.status_code}", level="error", response=response.text)
             return []
     except Exception as e:
-        print(f"Error fetching posts: {e}")
+        log(f"Error fetching posts: {e}", level="error")
         return []
 
-def get_random_image():
-    """Get a random image from Danbooru matching the tags"""
-    for attempt in range(MAX_RETRIES):
-        try:
-            # Try different pages to increase randomness
-            page = random.randint(1, 5)
-            posts = fetch_image_urls(page)
-
-            if not posts:
-                print(f"No posts found on page {page}, trying another approach...")
-                # Try the first page as fallback
-                if page != 1:
-                    posts = fetch_image_urls(1)
+def refresh_index():
+    """Keeps the local post index filled and up to date, a few bulk pages at a time."""
+    oldest, newest = index.id_range()
+    last_refresh = float(index.get_meta("last_refresh", 0))
 
+    # Pull in posts newer than anything we have, at most once per INDEX_REFRESH_INTERVAL
+    if newest is not None and time.time() - last_refresh >= INDEX_REFRESH_INTERVAL:
+        for _ in range(INDEX_PAGES_PER_UPDATE):
+            posts = fetch_posts(f"a{newest}")
             if posts:
-                # Select a random post from the results
-                post = random.choice(posts)
-                file_url = post['file_url']
-                print(f"Found image: ID {post.get('id')} - {os.path.basename(file_url)}")
+                log(f"Indexed {index.add(posts)} new posts")
+                newest = max(post["id"] for post in posts)
+            if len(posts) < PAGE_SIZE:
+                index.set_meta("last_refresh", time.time())
+                break
+
+    # Walk backwards through older posts until the index is big enough or we reach the first post
+    for _ in range(INDEX_PAGES_PER_UPDATE):
+        if len(index) >= INDEX_TARGET_SIZE or index.get_meta("reached_oldest"):
+            break
+        posts = fetch_posts(f"b{oldest}" if oldest is not None else 1)
+        if len(posts) < PAGE_SIZE:
+            index.set_meta("reached_oldest", 1)
+        if not posts:
+            break
+        log(f"Indexed {index.add(posts)} older posts ({len(index)} total)")
+        oldest = min(post["id"] for post in posts)
+        if newest is None:
+            index.set_meta("last_refresh", time.time())
+            newest = max(post["id"] for post in posts)
+
+def pick_file_url(post):
+    """Returns the original file, or Danbooru's resized sample if the original is over budget."""
+    too_big = (
+        (post.get("file_size") or 0) > MAX_BYTES
+        or (post.get("image_width") or 0) * (post.get("image_height") or 0) > MAX_PIXELS
+        or (post.get("file_ext") or "").upper().replace("JPG", "JPEG") not in ACCEPTED_FORMATS
+    )
+    if too_big and post.get("large_file_url"):
+        return post["large_file_url"]
+    return post["file_url"]
+
+def get_random_image(exclude=()):
+    """Pick a random indexed post, skipping IDs in `exclude`, and download it"""
+    for attempt in range(MAX_RETRIES):
+        try:
+            post = index.pick(exclude)
+            if post:
+                file_url = pick_file_url(post)
+                log(f"Found image: ID {post.get('id')} - {os.path.basename(file_url)}")
 
                 # Download the image
-                response = requests.get(file_url)
+                response = http_client.session.get(file_url)
                 if response.status_code == 200:
-                    return response.content
+                    index.mark_used(post["id"])
+                    return post, response.content
                 else:
-                    print(f"Failed to download image: HTTP {response.status_code}")
+                    log(f"Failed to download image: HTTP {response.status_code}", level="error")
+                    if response.status_code in (403, 404, 410):
+                        index.remove(post["id"])
             else:
-                print("No suitable posts found.")
+                log("No suitable posts found.", level="warning")
 
             # Add backoff time between retries
             if attempt < MAX_RETRIES - 1:
                 backoff = BACKOFF_TIME * (attempt + 1)
-                print(f"Backing off for {backoff} seconds before retry...")
+                log(f"Backing off for {backoff} seconds before retry...", level="warning")
                 time.sleep(backoff)
 
         except Exception as e:
-            print(f"Error in attempt {attempt+1}: {e}")
+            log(f"Error in attempt {attempt+1}: {e}", level="error")
             time.sleep(BACKOFF_TIME)
 
-    return None
+    return None, None
+
+def prepare_image(image_data):
+    """Returns (bytes, extension) ready to upload.
+
+    Images already in an accepted format and within MAX_PIXELS/MAX_BYTES are
+    kept byte-for-byte; only the header is parsed. Anything else is decoded
+    once, downscaled to fit and saved as JPEG (WebP if it has transparency).
+    """
+    img = Image.open(BytesIO(image_data))
+    fits = img.width * img.height <= MAX_PIXELS and len(image_data) <= MAX_BYTES
+    if img.format in ACCEPTED_FORMATS and fits:
+        # verify() checks the file is not truncated without decoding every pixel
+        img.verify()
+        return image_data, ACCEPTED_FORMATS[img.format]
+    return encode_within_budget(Image.open(BytesIO(image_data)))
+
+def encode_within_budget(img):
+    """Encodes `img` as compactly as needed to fit MAX_PIXELS and MAX_BYTES."""
+    if img.width * img.height > MAX_PIXELS:
+        scale = (MAX_PIXELS / (img.width * img.height)) ** 0.5
+        img.thumbnail((int(img.width * scale), int(img.height * scale)), Image.LANCZOS)
+
+    has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+    img = img.convert("RGBA" if has_alpha else "RGB")
+    fmt, ext = ("WEBP", ".webp") if has_alpha else ("JPEG", ".jpg")
+    options = {} if has_alpha else {"optimize": True, "progressive": True}
 
-def save_as_png(image_data, target_path):
-    """Convert image to PNG and save it to the specified path"""
+    while True:
+        for quality in JPEG_QUALITIES:
+            out = BytesIO()
+            img.save(out, fmt, quality=quality, **options)
+            if out.tell() <= MAX_BYTES:
+                return out.getvalue(), ext
+        # Still too big at the lowest quality, so halve the size and try again
+        img = img.resize((max(1, img.width // 2), max(1, img.height // 2)), Image.LANCZOS)
+
+def save_image(image_data, directory, name):
+    """Stores an image in `directory` as `name` plus the right extension. Returns the filename or None."""
     try:
-        img = Image.open(BytesIO(image_data))
+        data, ext = prepare_image(image_data)
 
         # Create directory if it doesn't exist
-        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        os.makedirs(directory, exist_ok=True)
 
-        # Save as PNG
-        img.save(target_path, "PNG")
-        print(f"Image saved to {target_path}")
-        return True
+        # Swap the file into place atomically so readers never see half an image
+        filename = f"{name}{ext}"
+        atomic_write(os.path.join(directory, filename), data)
+        log(f"Image saved to {os.path.join(directory, filename)} ({len(data) // 1024} KiB)")
+        return filename
     except Exception as e:
-        print(f"Error saving image: {e}")
+        log(f"Error saving image: {e}", level="error")
+        return None
+
+def add_to_pool(manifest):
+    """Downloads one new image into the pool. Returns False if that failed."""
+    post, image_data = get_random_image(exclude=[entry["post_id"] for entry in manifest["images"]])
+    if not image_data:
+        log("Failed to fetch a valid image after multiple attempts.", level="error")
+        return False
+
+    if any(entry["post_id"] == post["id"] for entry in manifest["images"]):
+        log(f"Post {post['id']} is already in the pool")
+        return False
+    filename = save_image(image_data, POOL_DIR, post["id"])
+    if not filename:
         return False
 
+    manifest["images"].append({"file": filename, "post_id": post["id"], "added_at": time.time()})
+    return True
+
+def retire_oldest(manifest):
+    """Takes the oldest images out of rotation until the pool is back to POOL_SIZE."""
+    while len(manifest["images"]) > POOL_SIZE:
+        entry = manifest["images"].pop(0)
+        manifest["retired"].append({"file": entry["file"], "retired_at": time.time()})
+
+def purge_retired(manifest):
+    """Deletes retired images once nobody can still be uploading them."""
+    keep = []
+    active = {entry["file"] for entry in manifest["images"]}
+    for entry in manifest["retired"]:
+        if time.time() - entry["retired_at"] < RETIRE_GRACE:
+            keep.append(entry)
+        elif entry["file"] not in active:
+            try:
+                os.remove(os.path.join(POOL_DIR, entry["file"]))
+            except FileNotFoundError:
+                pass
+    manifest["retired"] = keep
+
+def update_pool(manifest):
+    """Fills the pool up to POOL_SIZE, or swaps the oldest image for a new one once full."""
+    refresh_index()
+    if len(manifest["images"]) < POOL_SIZE:
+        # Fill quickly on startup instead of waiting a full interval per image
+        while len(manifest["images"]) < POOL_SIZE:
+            if not add_to_pool(manifest):
+                break
+            write_manifest(POOL_DIR, manifest)
+    elif add_to_pool(manifest):
+        retire_oldest(manifest)
+
+    purge_retired(manifest)
+    write_manifest(POOL_DIR, manifest)
+    log(f"Pool has {len(manifest['images'])}/{POOL_SIZE} images")
+
 def main():
     """Main function to run the image updater"""
-    print(f"Starting Danbooru Image Updater")
-    print(f"Images will be saved to {TARGET_FILE}")
-    print(f"Update interval: {UPDATE_INTERVAL} seconds")
-    print(f"Using tags: {TAGS}")
+    global index
+    index = PostIndex(INDEX_FILE, reuse_window=REUSE_WINDOW, extensions=INDEXED_EXTENSIONS)
+
+    log(f"Starting Danbooru Image Updater")
+    log(f"Images will be kept in {POOL_DIR} ({POOL_SIZE} at a time)")
+    log(f"Update interval: {UPDATE_INTERVAL} seconds")
+    log(f"Using tags: {TAGS}")
+    log(f"Post index: {INDEX_FILE} ({len(index)} posts)")
+
+    os.makedirs(POOL_DIR, exist_ok=True)
+    manifest = read_manifest(POOL_DIR)
+    # Drop entries whose files went missing while we were stopped
+    manifest["images"] = [e for e in manifest["images"] if os.path.exists(os.path.join(POOL_DIR, e["file"]))]
 
     while True:
         try:
-            print("\nFetching new image...")
-            image_data = get_random_image()
-
-            if image_data:
-                save_as_png(image_data, TARGET_FILE)
-            else:
-                print("Failed to fetch a valid image after multiple attempts.")
+            log("Updating image pool...")
+            update_pool(manifest)
 
-            print(f"Waiting {UPDATE_INTERVAL} seconds before next update...")
+            log(f"Waiting {UPDATE_INTERVAL} seconds before next update...")
             time.sleep(UPDATE_INTERVAL)
 
         except KeyboardInterrupt:
-            print("\nShutting down...")
+            log("Shutting down...")
             break
         except Exception as e:
-            print(f"Unexpected error: {e}")
-            print(f"Retrying in {UPDATE_INTERVAL} seconds...")
+            log(f"Unexpected error: {e}", level="error")
+            log(f"Retrying in {UPDATE_INTERVAL} seconds...", level="warning")
             time.sleep(UPDATE_INTERVAL)
 
 if __name__ == "__main__":
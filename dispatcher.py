@@ -0,0 +1,382 @@
+"""
+Mention Dispatcher
+Runs mention handlers on a bounded thread pool (or as asyncio tasks) while
+keeping mentions that belong to the same thread in order, and hands mentions
+that pile up in one thread to the handler as a single batch. Waiting work is
+shared fairly between the accounts that sent it (see fair_queue.py).
+"""
+
+import time
+import heapq
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from tracing import log
+from fair_queue import FairQueue
+
+SEEN_LIMIT = 10000  # how many notification IDs to remember for de-duplication
+DROP_TTL = 900  # seconds a shed notification may wait to be submitted again before the cursor moves past it
+
+
+class MentionDispatcher:
+    """Processes notifications in parallel, one batch at a time per thread key.
+
+    The handler is called with a list of items. Items submitted under the same
+    key run strictly in submission order; while one batch of a key is running,
+    later items of that key queue up and are handed over together (at most
+    `max_batch` at a time). A batch starts no earlier than `coalesce_window`
+    seconds after its oldest item arrived, so near-simultaneous items land in
+    it. Items with different keys run concurrently on up to `workers` threads,
+    and free workers take keys round-robin by the `account` they were
+    submitted with.
+
+    At most `max_pending` items are queued or running. A live item arriving
+    when that is full pushes out a queued one (see FairQueue.shed_one), and
+    each account may submit `user_rate` live items per minute (bursts of
+    `user_burst`). Catch-up items (`catch_up=True`, e.g. mentions that came in
+    while the bot was down) are never rate limited or shed; `submit` blocks
+    until there is room for them, or for a live item when nothing can be shed.
+
+    `on_commit` is called with the highest notification ID that has been fully
+    handled (or deliberately ignored) and is lower than every ID still pending,
+    so it is always safe to resume from that ID even when items arrive out of
+    order. Shed items stay pending, so the cursor never moves past them; they
+    are forgotten for de-duplication so the next poll can submit them again.
+    A shed item that a poll no longer returns (e.g. a deleted status), or
+    that isn't submitted again within `drop_ttl` seconds, is given up on
+    with `forget_dropped` or automatically, so the cursor can't get stuck.
+    """
+
+    def __init__(self, handler, workers=4, max_pending=100, on_commit=None, max_batch=1, coalesce_window=0.0,
+                 user_rate=0, user_burst=5, drop_ttl=DROP_TTL):
+        self._handler = handler
+        self._on_commit = on_commit
+        self._max_batch = max_batch
+        self._coalesce_window = coalesce_window
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mention")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._queue = FairQueue(user_rate, user_burst, coalesce_window)
+        self._cursor = _Cursor(on_commit)
+        self._drop_ttl = drop_ttl
+        self._seen = OrderedDict()
+
+    def submit(self, note_id, key, item, account=None, catch_up=False) -> bool:
+        """Queues an item. Returns False if the notification was already seen or is over its rate limit."""
+        entry = [note_id, False]
+        with self._lock:
+            if note_id in self._seen:
+                return False
+            self._remember(note_id)
+            self._cursor.add(note_id)
+            if not catch_up and not self._queue.admit(account):
+                _rate_limited(note_id, account)
+                self._complete(entry)
+                return False
+
+        shed = None
+        if not self._slots.acquire(blocking=False):
+            if not catch_up:
+                with self._lock:
+                    shed = self._queue.shed_one()
+                    if shed is not None:
+                        self._drop(shed)
+            # A shed item's slot goes to this one
+            if shed is None:
+                self._slots.acquire()
+        with self._lock:
+            ready = self._queue.add(key, account, entry, item, sheddable=not catch_up)
+        if shed is not None:
+            _report_shed(shed)
+        if ready:
+            self._executor.submit(self._next)
+        return True
+
+    def pending(self) -> int:
+        """Number of notifications queued or running."""
+        with self._lock:
+            return len(self._cursor)
+
+    def waiting(self) -> int:
+        """Number of queued notifications waiting for a free worker (not held back for batching)."""
+        with self._lock:
+            return self._queue.waiting
+
+    def dropped(self) -> int:
+        """Number of shed notifications that haven't been submitted again yet."""
+        with self._lock:
+            self._expire_dropped()
+            return self._cursor.held()
+
+    def dropped_ids(self) -> set:
+        """IDs of shed notifications that haven't been submitted again yet."""
+        with self._lock:
+            self._expire_dropped()
+            return self._cursor.held_ids()
+
+    def forget_dropped(self, note_ids):
+        """Gives up on shed notifications that won't come back, e.g. because a poll no longer returns them."""
+        with self._lock:
+            _report_forgotten(self._cursor.release(note_ids), "gone")
+
+    def _expire_dropped(self):
+        _report_forgotten(self._cursor.release(self._cursor.stale(self._drop_ttl)), "expired")
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _remember(self, note_id):
+        self._seen[note_id] = True
+        while len(self._seen) > SEEN_LIMIT:
+            self._seen.popitem(last=False)
+
+    def _next(self):
+        # Every ready key has a task like this one, but it runs whichever key is due next
+        with self._lock:
+            key = self._queue.next_key()
+            if key is None:
+                return
+            delay = self._queue.oldest(key) + self._coalesce_window - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        with self._lock:
+            entries, items = self._queue.take(key, self._max_batch)
+        try:
+            if items:
+                self._handler(items)
+        except Exception as e:
+            log(f"Error handling notifications {', '.join(str(done[0]) for done in entries)}: {e}", level="error")
+        finally:
+            for entry in entries:
+                self._finish(entry)
+            # More of this thread arrived meanwhile: it goes to the back of the line
+            with self._lock:
+                ready = self._queue.release(key)
+            if ready:
+                self._executor.submit(self._next)
+
+    def _complete(self, entry):
+        """Marks an entry done and commits. Call with the lock held."""
+        entry[1] = True
+        # Commit under the lock so callbacks never see the cursor move backwards
+        self._cursor.done(entry[0])
+
+    def _finish(self, entry):
+        with self._lock:
+            self._complete(entry)
+        self._slots.release()
+
+    def _drop(self, entry):
+        """Sheds an entry. Call with the lock held."""
+        self._cursor.hold(entry[0])
+        self._seen.pop(entry[0], None)
+
+
+class AsyncMentionDispatcher:
+    """asyncio counterpart of MentionDispatcher for the async engine.
+
+    Same guarantees: per-key order and batching, fair scheduling across
+    accounts, rate limits and shedding, de-duplication, at most `max_pending`
+    items queued or running, and an in-order `on_commit`. Up to `concurrency`
+    handlers run at once as tasks on one event loop. Create it inside that
+    loop.
+    """
+
+    def __init__(self, handler, concurrency=100, max_pending=1000, on_commit=None, max_batch=1, coalesce_window=0.0,
+                 user_rate=0, user_burst=5, drop_ttl=DROP_TTL):
+        self._handler = handler
+        self._on_commit = on_commit
+        self._max_batch = max_batch
+        self._coalesce_window = coalesce_window
+        self._running = asyncio.Semaphore(concurrency)
+        self._slots = asyncio.Semaphore(max_pending)
+        self._queue = FairQueue(user_rate, user_burst, coalesce_window)
+        self._cursor = _Cursor(on_commit)
+        self._drop_ttl = drop_ttl
+        self._seen = OrderedDict()
+        self._tasks = set()
+        self._loop = asyncio.get_running_loop()
+
+    async def submit(self, note_id, key, item, account=None, catch_up=False) -> bool:
+        """Queues an item. Returns False if the notification was already seen or is over its rate limit."""
+        if note_id in self._seen:
+            return False
+        self._remember(note_id)
+        self._cursor.add(note_id)
+        entry = [note_id, False]
+        if not catch_up and not self._queue.admit(account):
+            _rate_limited(note_id, account)
+            self._complete(entry)
+            return False
+
+        shed = self._queue.shed_one() if self._slots.locked() and not catch_up else None
+        if shed is not None:
+            # Its slot goes to this item
+            self._drop(shed)
+            _report_shed(shed)
+        else:
+            await self._slots.acquire()
+        ready = self._queue.add(key, account, entry, item, sheddable=not catch_up)
+        if ready:
+            self._start()
+        return True
+
+    def submit_threadsafe(self, note_id, key, item, account=None, catch_up=False) -> bool:
+        """`submit` for callers on other threads, such as the streaming listener. Blocks while full."""
+        future = asyncio.run_coroutine_threadsafe(self.submit(note_id, key, item, account, catch_up), self._loop)
+        return future.result()
+
+    def pending(self) -> int:
+        """Number of notifications queued or running."""
+        return len(self._cursor)
+
+    def waiting(self) -> int:
+        """Number of queued notifications waiting for a free worker (not held back for batching)."""
+        return self._queue.waiting
+
+    def dropped(self) -> int:
+        """Number of shed notifications that haven't been submitted again yet."""
+        self._expire_dropped()
+        return self._cursor.held()
+
+    def dropped_ids(self) -> set:
+        """IDs of shed notifications that haven't been submitted again yet."""
+        self._expire_dropped()
+        return self._cursor.held_ids()
+
+    def forget_dropped(self, note_ids):
+        """Gives up on shed notifications that won't come back, e.g. because a poll no longer returns them."""
+        _report_forgotten(self._cursor.release(note_ids), "gone")
+
+    def _expire_dropped(self):
+        _report_forgotten(self._cursor.release(self._cursor.stale(self._drop_ttl)), "expired")
+
+    async def shutdown(self):
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _remember(self, note_id):
+        self._seen[note_id] = True
+        while len(self._seen) > SEEN_LIMIT:
+            self._seen.popitem(last=False)
+
+    def _start(self):
+        task = asyncio.create_task(self._next())
+        # The loop only keeps weak references to tasks
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _next(self):
+        # Pick the key only once a slot is free, so the fair queue decides who goes next
+        async with self._running:
+            key = self._queue.next_key()
+            if key is None:
+                return
+            delay = self._queue.oldest(key) + self._coalesce_window - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            entries, items = self._queue.take(key, self._max_batch)
+            try:
+                if items:
+                    await self._handler(items)
+            except Exception as e:
+                log(f"Error handling notifications {', '.join(str(done[0]) for done in entries)}: {e}", level="error")
+            finally:
+                for entry in entries:
+                    self._complete(entry)
+                    self._slots.release()
+                if self._queue.release(key):
+                    self._start()
+
+    def _complete(self, entry):
+        entry[1] = True
+        self._cursor.done(entry[0])
+
+    def _drop(self, entry):
+        self._cursor.hold(entry[0])
+        self._seen.pop(entry[0], None)
+
+
+class _Cursor:
+    """Tracks pending notification IDs and commits handled ones in ID order.
+
+    Streaming and the catch-up poll can submit notifications out of order, so
+    the committed ID is the highest handled one below every pending ID, and
+    it never moves backwards. Held (shed) IDs count as pending until they are
+    added again and handled, or released. Not thread-safe.
+    """
+
+    def __init__(self, on_commit):
+        self._on_commit = on_commit
+        self._pending = {}  # note_id -> sort key
+        self._held = {}  # note_id -> when it was held (monotonic time)
+        self._handled = []  # heap of (sort key, note_id) not committed yet
+        self._committed = None  # sort key of the last committed ID
+
+    def __len__(self):
+        return len(self._pending) - len(self._held)
+
+    def held(self) -> int:
+        return len(self._held)
+
+    def held_ids(self) -> set:
+        return set(self._held)
+
+    def add(self, note_id):
+        self._pending[note_id] = notification_order(note_id)
+        self._held.pop(note_id, None)
+
+    def hold(self, note_id):
+        self._held[note_id] = time.monotonic()
+
+    def stale(self, max_age) -> list:
+        """Held IDs that have been held for more than `max_age` seconds."""
+        due = time.monotonic() - max_age
+        return [note_id for note_id, held_at in self._held.items() if held_at < due]
+
+    def release(self, note_ids) -> list:
+        """Stops holding IDs and treats them as handled. Returns the ones that were held."""
+        released = [note_id for note_id in note_ids if self._held.pop(note_id, None) is not None]
+        for note_id in released:
+            self.done(note_id)
+        return released
+
+    def done(self, note_id):
+        order = self._pending.pop(note_id, None)
+        if order is None:
+            return
+        heapq.heappush(self._handled, (order, note_id))
+        lowest = min(self._pending.values(), default=None)
+        committed = None
+        while self._handled and (lowest is None or self._handled[0][0] < lowest):
+            committed = heapq.heappop(self._handled)
+        if committed is None or (self._committed is not None and committed[0] <= self._committed):
+            return
+        self._committed = committed[0]
+        if self._on_commit:
+            self._on_commit(committed[1])
+
+
+def notification_order(note_id):
+    """Sort key for notification IDs: numeric on Mastodon (even as strings), sortable strings elsewhere."""
+    text = str(note_id)
+    return (0, int(text), "") if text.isdigit() else (1, 0, text)
+
+
+def _rate_limited(note_id, account):
+    log(f"Ignoring notification {note_id}: @{account} is over the per-user rate limit", level="warning")
+    metrics.inc("mentions_shed_total", reason="rate_limit")
+
+
+def _report_forgotten(note_ids, reason):
+    for note_id in note_ids:
+        log(f"Gave up on dropped notification {note_id} ({reason}), moving the cursor past it", level="warning")
+        metrics.inc("mentions_forgotten_total", reason=reason)
+
+
+def _report_shed(entry):
+    log(f"Mention queue full, dropped {entry[0]} for now; it is retried on the next poll", level="warning")
+    metrics.inc("mentions_shed_total", reason="overload")
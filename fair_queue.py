@@ -0,0 +1,161 @@
+"""
+Fair Queue
+Mentions waiting for a worker, grouped by thread and handed out round-robin
+across the accounts that sent them, so one account flooding the bot can't
+starve everyone else. Also enforces per-account rate limits and picks what
+to shed once too much has piled up.
+"""
+
+import time
+from collections import Counter, OrderedDict, deque
+
+import metrics
+from scheduler import TokenBucket
+
+ACCOUNT_LIMIT = 10000  # rate limit buckets kept, for the most recently seen accounts
+
+
+class FairQueue:
+    """Queued items per thread key, with keys scheduled round-robin by account.
+
+    A key is ready (waiting for a worker), running, or unknown; items of one
+    key always come out in the order they were added. When the caller runs
+    out of room, `shed_one` picks the oldest sheddable item of the account
+    with the most of them, so a flood mostly costs the account causing it.
+    Items still inside their `coalesce_window` are about to be batched rather
+    than backed up, so they are never shed. `user_rate` limits each account
+    to that many mentions per minute, with bursts of up to `user_burst`.
+
+    `waiting` counts the items of ready keys, i.e. work that a free worker
+    could start on now; items of running keys (still in their coalesce window,
+    or behind a batch of the same thread) are left out.
+
+    Not thread-safe; the dispatchers call it with their lock held or from
+    their event loop.
+    """
+
+    def __init__(self, user_rate=0, user_burst=5, coalesce_window=0.0):
+        self._user_rate = user_rate
+        self._user_burst = user_burst
+        self._coalesce_window = coalesce_window
+        self._items = {}  # key -> deque of (entry, item, account, queued_at, sheddable)
+        self._ready = OrderedDict()  # account -> deque of ready keys, in round-robin order
+        self._running = set()
+        self._buckets = OrderedDict()  # account -> TokenBucket, least recently seen first
+        self._depth = 0
+        self._waiting = 0
+
+    def __len__(self):
+        return self._depth
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    def admit(self, account) -> bool:
+        """Counts a mention against `account`'s rate limit. False if it is over the limit."""
+        if not self._user_rate or account is None:
+            return True
+        bucket = self._buckets.pop(account, None) or TokenBucket(self._user_burst, self._user_rate / 60)
+        self._buckets[account] = bucket
+        while len(self._buckets) > ACCOUNT_LIMIT:
+            self._buckets.popitem(last=False)
+        bucket.refill(time.monotonic())
+        if bucket.tokens < 1:
+            return False
+        bucket.tokens -= 1
+        return True
+
+    def add(self, key, account, entry, item, sheddable=True) -> bool:
+        """Queues an item. Returns True if its key became ready and needs a worker."""
+        queued = self._items.get(key)
+        new = queued is None
+        if new:
+            queued = self._items[key] = deque()
+            self._ready.setdefault(account, deque()).append(key)
+        queued.append((entry, item, account, time.monotonic(), sheddable))
+        self._set_depth(self._depth + 1)
+        if key not in self._running:
+            self._set_waiting(self._waiting + 1)
+        return new
+
+    def next_key(self):
+        """Marks the next ready key as running, taking accounts in turn. None if nothing is ready."""
+        if not self._ready:
+            return None
+        account, keys = self._ready.popitem(last=False)
+        key = keys.popleft()
+        if keys:
+            self._ready[account] = keys  # back of the line
+        self._running.add(key)
+        self._set_waiting(self._waiting - len(self._items[key]))
+        return key
+
+    def oldest(self, key) -> float:
+        """When the oldest queued item of `key` was added (monotonic time), or now if it has none."""
+        queued = self._items.get(key)
+        return queued[0][3] if queued else time.monotonic()
+
+    def take(self, key, max_batch) -> tuple:
+        """Removes up to `max_batch` items of a running key. Returns (entries, items)."""
+        queued = self._items.get(key) or deque()
+        entries, items = [], []
+        now = time.monotonic()
+        while queued and len(items) < max_batch:
+            entry, item, _, queued_at, _ = queued.popleft()
+            metrics.observe("mention_queue_wait_seconds", now - queued_at)
+            entries.append(entry)
+            items.append(item)
+        self._set_depth(self._depth - len(items))
+        return entries, items
+
+    def release(self, key) -> bool:
+        """Ends a key's running batch. Returns True if it has more items and is ready again."""
+        self._running.discard(key)
+        queued = self._items.get(key)
+        if not queued:
+            self._items.pop(key, None)
+            return False
+        self._ready.setdefault(queued[0][2], deque()).append(key)
+        self._set_waiting(self._waiting + len(queued))
+        return True
+
+    def shed_one(self):
+        """Drops one item to make room. Returns its entry, or None if nothing may be shed."""
+        due = time.monotonic() - self._coalesce_window
+        counts, oldest = Counter(), {}  # account -> sheddable items, (queued_at, key, index) of its oldest
+        for key, queued in self._items.items():
+            for i, (_, _, account, queued_at, sheddable) in enumerate(queued):
+                if sheddable and queued_at <= due:
+                    counts[account] += 1
+                    if account not in oldest or queued_at < oldest[account][0]:
+                        oldest[account] = (queued_at, key, i)
+        if not counts:
+            return None
+        _, key, i = oldest[counts.most_common(1)[0][0]]
+        queued = self._items[key]
+        entry = queued[i][0]
+        del queued[i]
+        self._set_depth(self._depth - 1)
+        if key not in self._running:
+            self._set_waiting(self._waiting - 1)
+        if not queued and key not in self._running:
+            self._forget(key)
+        return entry
+
+    def _forget(self, key):
+        del self._items[key]
+        for account, keys in list(self._ready.items()):
+            if key in keys:
+                keys.remove(key)
+                if not keys:
+                    del self._ready[account]
+                return
+
+    def _set_depth(self, depth):
+        self._depth = depth
+        metrics.set_gauge("mention_queue_depth", depth)
+
+    def _set_waiting(self, waiting):
+        self._waiting = waiting
+        metrics.set_gauge("mention_queue_waiting", waiting)
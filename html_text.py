@@ -0,0 +1,138 @@
+"""
+HTML to Text
+Converter from Mastodon status HTML (or any web page) to the plain text we
+put in prompts and tool results. Every step is a precompiled re.sub with a
+plain replacement string, so the work stays in C.
+"""
+
+import re
+import html
+from functools import lru_cache
+
+SKIP_TAGS = ("script", "style", "noscript", "template", "svg")
+LINE_BREAK_TAGS = frozenset({
+    "br", "p", "div", "li", "ul", "ol", "blockquote", "pre", "tr", "table",
+    "h1", "h2", "h3", "h4", "h5", "h6", "section", "article", "header", "footer",
+})
+MAX_ENTITY_LENGTH = 32
+
+_SKIP = re.compile(rf"<({'|'.join(SKIP_TAGS)})\b[^>]*>.*?</\1\s*>", re.S | re.I | re.A)
+_COMMENT = re.compile(r"<!--.*?-->|<![^>]*>", re.S)
+# Case-insensitive matching makes the tag alternation several times slower, so it is only used when a tag is uppercase
+_LINE_BREAK = re.compile(rf"</?(?:{'|'.join(sorted(LINE_BREAK_TAGS))})(?=[\s/>])[^>]*>")
+_LINE_BREAK_ANY_CASE = re.compile(_LINE_BREAK.pattern, re.I | re.A)
+_UPPERCASE_TAG = re.compile(r"</?[A-Z]")
+# Entities in nearly every post; anything else goes through html.unescape
+_COMMON_ENTITIES = (("&lt;", "<"), ("&gt;", ">"), ("&quot;", '"'), ("&#39;", "'"))
+_OTHER_ENTITY = re.compile(r"&(?!amp;)")
+_SKIP_OPENERS = tuple(f"<{tag}" for tag in SKIP_TAGS)
+# Whitespace that needs collapsing; str searches are much cheaper than a regex over every character
+_MESSY_WHITESPACE = ("  ", " \n", "\n ", "\t", "\r", "\xa0")
+_TAG = re.compile(r"<[^>]+>")
+# An opening tag whose contents are dropped as a unit and must not be split across chunks
+_SKIP_OPEN = re.compile(rf"<({'|'.join(SKIP_TAGS)})\b", re.I)
+
+
+@lru_cache(maxsize=16)
+def _mention_pattern(bot_acct):
+    # "@clod" and "thanks @clod." but not "@clodette" or "@clod.fan"; a full acct also matches by its local part
+    names = dict.fromkeys((bot_acct, bot_acct.split("@")[0]))
+    # The spaces after it go too, so "@clod hi" doesn't leave a line that needs collapsing
+    return re.compile(rf"@(?:{'|'.join(map(re.escape, names))})(?![\w@-]|\.\w)[ \t]*", re.IGNORECASE | re.ASCII)
+
+
+class HTMLTextConverter:
+    """Incremental HTML -> text converter.
+
+    Feed it HTML in chunks; <br> and block tags become newlines, entities are
+    unescaped, <script>/<style> are dropped and, if `bot_acct` is given,
+    mentions of the bot are removed, all in the same pass. `length` is the
+    number of characters produced so far, so callers can stop feeding early.
+    """
+
+    def __init__(self, bot_acct=None, collapse_whitespace=False):
+        self._collapse = collapse_whitespace
+        self._bot_pattern = _mention_pattern(bot_acct) if bot_acct else None
+        self._buffer = ""
+        self._out = []
+        self.length = 0
+
+    def feed(self, chunk: str):
+        data = self._buffer + chunk
+        cut = self._safe_end(data)
+        self._convert(data[:cut])
+        self._buffer = data[cut:]
+
+    def close(self) -> str:
+        """Finishes parsing and returns the text."""
+        if self._buffer:
+            self._convert(self._buffer)
+            self._buffer = ""
+        return self.text()
+
+    def text(self) -> str:
+        """Returns the text converted so far, without any input still buffered."""
+        text = "".join(self._out)
+        if self._bot_pattern is not None:
+            text = self._bot_pattern.sub("", text)
+        if self._collapse:
+            return " ".join(text.split())
+        # Drop blank lines; only lines with stray whitespace need collapsing, which is rare
+        if text[:1] == " " or text[-1:] == " " or any(ws in text for ws in _MESSY_WHITESPACE):
+            return "\n".join(filter(None, (" ".join(line.split()) for line in text.split("\n"))))
+        return "\n".join(filter(None, text.split("\n")))
+
+    def _safe_end(self, data):
+        """Returns how much of `data` can be converted without splitting a token."""
+        cut = len(data)
+        # A tag that hasn't been closed yet
+        lt = data.rfind("<")
+        if lt != -1 and ">" not in data[lt:]:
+            cut = lt
+        # A <script>/<style> whose closing tag hasn't arrived yet
+        last = None
+        for last in _SKIP_OPEN.finditer(data, 0, cut):
+            pass
+        if last is not None and data.lower().find(f"</{last.group(1).lower()}", last.end(), cut) == -1:
+            cut = last.start()
+        # An entity split across chunks
+        amp = data.rfind("&", max(0, cut - MAX_ENTITY_LENGTH), cut)
+        if amp != -1 and ";" not in data[amp:cut]:
+            cut = amp
+        return cut
+
+    def _convert(self, data):
+        if not data:
+            return
+        text = data
+        if "<" in text:
+            uppercase = _UPPERCASE_TAG.search(text) is not None
+            if uppercase or any(opener in text for opener in _SKIP_OPENERS):
+                text = _SKIP.sub("\n", text)
+            if "<!" in text:
+                text = _COMMENT.sub("", text)
+            line_break = _LINE_BREAK_ANY_CASE if uppercase else _LINE_BREAK
+            text = _TAG.sub("", line_break.sub("\n", text))
+        if "&" in text:
+            text = _unescape(text)
+        self._out.append(text)
+        self.length += len(text)
+
+
+def _unescape(text: str) -> str:
+    unescaped = text
+    for entity, char in _COMMON_ENTITIES:
+        unescaped = unescaped.replace(entity, char)
+    if _OTHER_ENTITY.search(unescaped):
+        return html.unescape(text)
+    # &amp; last, so "&amp;lt;" stays "&lt;"
+    return unescaped.replace("&amp;", "&")
+
+
+def html_to_text(content: str, bot_acct=None, collapse_whitespace=False) -> str:
+    """Converts an HTML string to plain text."""
+    if not content:
+        return ""
+    converter = HTMLTextConverter(bot_acct=bot_acct, collapse_whitespace=collapse_whitespace)
+    converter._convert(content)
+    return converter.close()
@@ -0,0 +1,171 @@
+"""
+HTTP Client
+One pooled requests session that every outbound HTTP call goes through:
+keep-alive connection pools per host, default timeouts, retries with
+backoff on 429/5xx, optional per-host rate limiters, and per-host
+request/connection metrics. The async engine gets an httpx.AsyncClient
+with the same settings.
+"""
+
+import os
+import time
+import asyncio
+import threading
+import functools
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+USER_AGENT = "mastodon-epic-gemini-bot/1.0"
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session_lock = threading.Lock()
+
+
+@functools.cache
+def settings() -> dict:
+    """HTTP_* settings, read on first use; the entry point loads .env before that."""
+    return {
+        "pool_size": int(os.getenv("HTTP_POOL_SIZE", 16)),  # keep-alive connections per host
+        "connect_timeout": float(os.getenv("HTTP_CONNECT_TIMEOUT", 5)),
+        "read_timeout": float(os.getenv("HTTP_READ_TIMEOUT", 30)),
+        "retries": int(os.getenv("HTTP_RETRIES", 3)),
+        "backoff": float(os.getenv("HTTP_BACKOFF", 0.5)),  # seconds, doubled on every retry
+    }
+
+
+class PooledSession(requests.Session):
+    """requests.Session with shared per-host pools, default timeouts and metrics.
+
+    Arguments left as None come from `settings()`.
+    """
+
+    def __init__(self, pool_size=None, timeout=None, retries=None, backoff=None):
+        super().__init__()
+        config = settings()
+        pool_size = pool_size or config["pool_size"]
+        retries = config["retries"] if retries is None else retries
+        backoff = config["backoff"] if backoff is None else backoff
+        self.default_timeout = timeout or (config["connect_timeout"], config["read_timeout"])
+        self.limiters = {}  # host -> RateLimiter-like object with acquire() and observe_headers()
+        self.headers["User-Agent"] = USER_AGENT
+        # Only idempotent methods are retried, so a failed status_post is never sent twice
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUSES,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=pool_size, max_retries=retry)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def limit_host(self, host, limiter):
+        """Makes every request to `host` wait for `limiter` and report the response headers to it."""
+        self.limiters[host] = limiter
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.default_timeout
+        host = urlsplit(url).hostname or ""
+        limiter = self.limiters.get(host)
+        if limiter is not None:
+            limiter.acquire()
+        started = time.monotonic()
+        try:
+            response = super().request(method, url, **kwargs)
+        except requests.RequestException as e:
+            metrics.inc("http_requests_total", host=host, status=type(e).__name__)
+            raise
+        finally:
+            metrics.inc("http_request_seconds_total", time.monotonic() - started, host=host)
+        metrics.inc("http_requests_total", host=host, status=str(response.status_code))
+        if limiter is not None:
+            limiter.observe_headers(response.headers)
+        # num_connections only grows when a new TCP+TLS connection has to be opened
+        stats = self.connection_stats().get(host)
+        if stats:
+            metrics.set_gauge("http_connections_opened", stats["connections"], host=host)
+            metrics.set_gauge("http_pool_requests", stats["requests"], host=host)
+        return response
+
+    def connection_stats(self) -> dict:
+        """Returns {host: {"connections": opened, "requests": sent}} across all pools."""
+        stats = {}
+        # Both schemes share one adapter; count each pool manager once
+        managers = {id(a.poolmanager): a.poolmanager for a in self.adapters.values()}
+        for container in (m.pools for m in managers.values()):
+            for key in list(container.keys()):
+                pool = container.get(key)
+                if pool is None:
+                    continue
+                host = stats.setdefault(pool.host, {"connections": 0, "requests": 0})
+                host["connections"] += pool.num_connections
+                host["requests"] += pool.num_requests
+        return stats
+
+
+def __getattr__(name):
+    # `session`, shared by the bot, its tools and danbooru.py, is built on first use
+    if name != "session":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _session_lock:
+        if "session" not in globals():
+            globals()["session"] = PooledSession()
+        return globals()["session"]
+
+
+class RetryTransport(httpx.AsyncHTTPTransport):
+    """Retries idempotent requests on 429/5xx with the same backoff as `session`."""
+
+    def __init__(self, retries=None, backoff=None, **kwargs):
+        retries = settings()["retries"] if retries is None else retries
+        backoff = settings()["backoff"] if backoff is None else backoff
+        super().__init__(retries=retries, **kwargs)  # httpx itself only retries failed connects
+        self._retries = retries
+        self._backoff = backoff
+
+    async def handle_async_request(self, request):
+        for attempt in range(self._retries + 1):
+            response = await super().handle_async_request(request)
+            if request.method not in ("GET", "HEAD") or response.status_code not in RETRY_STATUSES \
+                    or attempt == self._retries:
+                return response
+            retry_after = response.headers.get("Retry-After", "")
+            delay = float(retry_after) if retry_after.isdigit() else self._backoff * (2 ** attempt)
+            await response.aclose()
+            await asyncio.sleep(delay)
+        return response
+
+
+async def _record_request(request):
+    request.extensions["started"] = time.monotonic()
+
+
+async def _record_response(response):
+    host = response.request.url.host
+    metrics.inc("http_requests_total", host=host, status=str(response.status_code))
+    metrics.inc("http_request_seconds_total", time.monotonic() - response.request.extensions["started"], host=host)
+
+
+def async_client(pool_size=None) -> httpx.AsyncClient:
+    """An httpx.AsyncClient with the pool size, timeouts, retries and metrics of `session`.
+
+    Must be created and closed inside the event loop that uses it.
+    """
+    config = settings()
+    pool_size = pool_size or config["pool_size"]
+    limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+    return httpx.AsyncClient(
+        transport=RetryTransport(limits=limits),
+        timeout=httpx.Timeout(config["read_timeout"], connect=config["connect_timeout"]),
+        headers={"User-Agent": USER_AGENT},
+        follow_redirects=True,
+        event_hooks={"request": [_record_request], "response": [_record_response]},
+    )
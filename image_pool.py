@@ -0,0 +1,93 @@
+"""
+Image Pool
+A directory of ready-to-post images plus a small manifest. danbooru.py keeps
+it filled; main.py takes a different image from it for every reply.
+"""
+
+import os
+import json
+import tempfile
+import threading
+
+MANIFEST_NAME = "manifest.json"
+
+
+def atomic_write(path: str, data: bytes):
+    """Writes `data` to `path` so readers only ever see the old or the new file."""
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def read_manifest(directory: str) -> dict:
+    """Returns {"images": [...], "retired": [...]}; empty if there is no pool yet."""
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME), "r") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        manifest = {}
+    manifest.setdefault("images", [])
+    manifest.setdefault("retired", [])
+    return manifest
+
+
+def write_manifest(directory: str, manifest: dict):
+    atomic_write(os.path.join(directory, MANIFEST_NAME), json.dumps(manifest).encode())
+
+
+class ImagePoolReader:
+    """Hands out pool images round-robin, reloading the manifest when it changes.
+
+    `next()` is O(1): a stat of the manifest and an index into the cached list.
+    Falls back to `fallback` (if it exists) while the pool is empty.
+    """
+
+    def __init__(self, directory: str, fallback: str = None):
+        self._directory = directory
+        self._fallback = fallback
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._paths = []
+        self._index = 0
+
+    def _reload(self):
+        try:
+            mtime = os.stat(os.path.join(self._directory, MANIFEST_NAME)).st_mtime_ns
+        except OSError:
+            mtime = None
+        with self._lock:
+            if mtime == self._mtime:
+                return self._paths
+            manifest = read_manifest(self._directory)
+            self._paths = [os.path.join(self._directory, entry["file"]) for entry in manifest["images"]]
+            self._mtime = mtime
+            return self._paths
+
+    def next(self):
+        """Returns the path of the next image, or None if there is nothing to post."""
+        paths = self._reload()
+        if paths:
+            with self._lock:
+                index = self._index
+                self._index += 1
+            return paths[index % len(paths)]
+        if self._fallback and os.path.exists(self._fallback):
+            return self._fallback
+        return None
+
+    def peek(self):
+        """Returns the image the next call to `next()` will most likely hand out."""
+        paths = self._reload()
+        if not paths:
+            return None
+        with self._lock:
+            return paths[self._index % len(paths)]
@@ -1,15 +1,42 @@
 import os
 import re
 import time
-import html
 import json
-import requests
+import httpx
+import asyncio
+import codecs
+import signal
 import argparse
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 from dotenv import load_dotenv
-from mastodon import Mastodon, MastodonError
+from mastodon import Mastodon, MastodonError, MastodonNotFoundError, StreamListener
 from google import genai
 from google.genai import types
-from openai import OpenAI
+from google.genai import errors as genai_errors
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient, RateLimitError
+import http_client
+import metrics
+import tracing
+from tracing import log
+from profiling import MentionProfiler
+from cache import TTLCache
+from tool_registry import ToolRegistry
+from dispatcher import MentionDispatcher, AsyncMentionDispatcher, notification_order
+from html_text import HTMLTextConverter, html_to_text
+from page_cache import PageCache
+from thread_store import ThreadStore
+from prompt_builder import PromptBuilder, estimate_tokens
+from prompt_cache import GeminiContextCache
+from media_cache import MediaCache
+from image_pool import ImagePoolReader
+from scheduler import RateLimiter, background, retry_after
+from provider_router import ProviderRouter
+from tiering import Tier, TierPolicy
 
 # Load environment variables from .env file
 load_dotenv()
@@ -20,11 +47,27 @@ ACCESS_TOKEN = os.getenv("MASTODON_ACCESS_TOKEN")
 
 # AI Provider Configuration
 AI_PROVIDER = os.getenv("AI_PROVIDER", "gemini").lower()  # "gemini" or "openai"
+AI_FALLBACK_PROVIDER = os.getenv("AI_FALLBACK_PROVIDER", "none").lower()  # the other one, to fail over and hedge to
+LLM_HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", 10))  # seconds before also asking the fallback; 0 only fails over
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", 5))  # failures in a row before a provider is skipped
+LLM_BREAKER_COOLDOWN = int(os.getenv("LLM_BREAKER_COOLDOWN", 60))  # seconds a failing provider is skipped
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
+GEMINI_FAST_MODEL = os.getenv("GEMINI_FAST_MODEL", GEMINI_MODEL)  # used under load
+OPENAI_FAST_MODEL = os.getenv("OPENAI_FAST_MODEL", OPENAI_MODEL)
+TIER_QUEUE_PRESSURE = int(os.getenv("TIER_QUEUE_PRESSURE", 20))  # mentions waiting for a free worker that count as load; 0 turns tiering off
+TIER_LATENCY_PRESSURE = float(os.getenv("TIER_LATENCY_PRESSURE", 20))  # median reply seconds that count as load
+TIER_DWELL = int(os.getenv("TIER_DWELL", 60))  # seconds to stay in a tier before moving again
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1/") 
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "true").lower() in ("1", "true", "yes", "on")
+GEMINI_CACHE_TTL = int(os.getenv("GEMINI_CACHE_TTL", 3600))  # seconds; renewed automatically while in use
+OPENAI_PROMPT_CACHE_KEY = os.getenv("OPENAI_PROMPT_CACHE_KEY")  # only sent if set; not every compatible API accepts it
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", 0))  # requests per minute allowed by your Gemini tier; 0 means unlimited
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", 0))  # tokens per minute; 0 means unlimited
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", 0))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", 0))
 
 SYSTEM_INSTRUCTION = os.getenv(
     "SYSTEM_INSTRUCTION",
@@ -32,35 +75,146 @@ SYSTEM_INSTRUCTION = os.getenv(
 
 )
 POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", 30))
+INTAKE_MODE = os.getenv("INTAKE_MODE", "stream").lower()  # "stream" or "poll"
+ENGINE = os.getenv("ENGINE", "async").lower()  # "async", or "sync" for the thread-per-mention engine
+ASYNC_CONCURRENCY = int(os.getenv("ASYNC_CONCURRENCY", 100))  # mentions handled at once by the async engine
+BLOCKING_POOL_SIZE = int(os.getenv("BLOCKING_POOL_SIZE", 32))  # threads for Mastodon.py calls in the async engine
+STREAM_RECONNECT_WAIT = int(os.getenv("STREAM_RECONNECT_WAIT", 5))  # seconds between stream reconnect attempts
+MASTODON_RATE_LIMIT = int(os.getenv("MASTODON_RATE_LIMIT", 300))  # requests per 5 minutes until the server tells us otherwise
+QUOTA_RESERVE = float(os.getenv("QUOTA_RESERVE", 0.1))  # share of each quota that tool lookups leave for replies
+ERROR_BACKOFF_MAX = 60  # longest wait after repeated intake errors
+MEDIA_CACHE_MODE = os.getenv("MEDIA_CACHE_MODE", "prefetch").lower()  # "prefetch" or "reuse"
+TOOL_CACHE_SIZE = int(os.getenv("TOOL_CACHE_SIZE", 512))  # max cached tool results
+TOOL_CACHE_NEGATIVE_TTL = int(os.getenv("TOOL_CACHE_NEGATIVE_TTL", 60))  # seconds to remember "not found"
+FETCH_URL_MAX_CHARS = 2000  # text returned to the model per page
+FETCH_URL_MAX_BYTES = int(os.getenv("FETCH_URL_MAX_BYTES", 2 * 1024 * 1024))  # stop downloading after this much
+FETCH_URL_TIMEOUT = float(os.getenv("FETCH_URL_TIMEOUT", 15))  # seconds for the whole download; keep it under the tool's timeout
+PAGE_CACHE_DIR = os.getenv("PAGE_CACHE_DIR", "./page_cache")
+TEXT_CONTENT_TYPES = {"application/xhtml+xml", "application/xml", "application/json", "application/rss+xml", "application/atom+xml"}
+TOOL_POOL_SIZE = int(os.getenv("TOOL_POOL_SIZE", 8))  # tool calls run in parallel across all mentions
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", 15))  # seconds before a tool call is abandoned, unless the tool sets its own
+IMAGE_POOL_SIZE = int(os.getenv("IMAGE_POOL_SIZE", 8))  # attachment downloads in parallel across all mentions
+IMAGE_DOWNLOAD_TIMEOUT = float(os.getenv("IMAGE_DOWNLOAD_TIMEOUT", 10))  # seconds per attachment download
+IMAGE_MAX_TOTAL_BYTES = int(os.getenv("IMAGE_MAX_TOTAL_BYTES", 20 * 1024 * 1024))  # per mention, across all attachments
+THREAD_CACHE_TTL = int(os.getenv("THREAD_CACHE_TTL", 600))  # seconds before a cached thread is refetched
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 3000))  # estimated tokens of thread in the prompt
+PROMPT_RECENT_TURNS = int(os.getenv("PROMPT_RECENT_TURNS", 6))  # newest posts always kept in full
+WORKER_POOL_SIZE = int(os.getenv("WORKER_POOL_SIZE", 4))  # mentions processed in parallel
+WORKER_QUEUE_DEPTH = int(os.getenv("WORKER_QUEUE_DEPTH", 100))  # max mentions queued or running
+MENTION_BATCH_WINDOW = float(os.getenv("MENTION_BATCH_WINDOW", 1.0))  # seconds to wait for more mentions in a thread
+MENTION_BATCH_MAX = int(os.getenv("MENTION_BATCH_MAX", 10))  # most mentions answered by one reply
+USER_MENTIONS_PER_MINUTE = float(os.getenv("USER_MENTIONS_PER_MINUTE", 0))  # per account; 0 means unlimited
+USER_MENTION_BURST = int(os.getenv("USER_MENTION_BURST", 5))  # mentions an account can send at once
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9464))  # Prometheus endpoint on localhost; 0 turns it off
+PROFILE_DIR = os.getenv("PROFILE_DIR", "./profiles")  # where --profile and SIGUSR1 write .prof files
+PROFILE_MENTIONS = int(os.getenv("PROFILE_MENTIONS", 5))  # mentions profiled after each SIGUSR1
 YAOI_MODE_FILE = "yaoi_mode_users.json"
+YAOI_POOL_DIR = os.getenv("YAOI_POOL_DIR", "./image_pool")  # filled by danbooru.py
+YAOI_FALLBACK_IMAGE = "./image.png"  # used while the pool is empty
+CURSOR_FILE = "notification_cursor.json"  # last fully handled notification, survives restarts
+NOTIFICATION_PAGE_SIZE = 80  # Mastodon's maximum page size for notifications
 
 # --- Check tokens ---
 if not ACCESS_TOKEN:
     raise RuntimeError("Please set MASTODON_ACCESS_TOKEN.")
 
-if AI_PROVIDER == "gemini" and not GEMINI_API_KEY:
+# Primary provider first, then the fallback if there is one
+PROVIDERS = [AI_PROVIDER] + ([AI_FALLBACK_PROVIDER] if AI_FALLBACK_PROVIDER not in ("none", "", AI_PROVIDER) else [])
+for provider in PROVIDERS:
+    if provider not in ("gemini", "openai"):
+        raise ValueError(f"Unknown AI provider: {provider}")
+
+if "gemini" in PROVIDERS and not GEMINI_API_KEY:
     raise RuntimeError("Please set GEMINI_API_KEY when using Gemini provider.")
-elif AI_PROVIDER == "openai" and not OPENAI_API_KEY:
+if "openai" in PROVIDERS and not OPENAI_API_KEY:
     raise RuntimeError("Please set OPENAI_API_KEY when using OpenAI provider.")
 
 # --- Clients ---
-mastodon = Mastodon(access_token=ACCESS_TOKEN, api_base_url=MASTODON_BASE_URL)
+# All Mastodon API calls share the pooled keep-alive session in http_client
+mastodon = Mastodon(access_token=ACCESS_TOKEN, api_base_url=MASTODON_BASE_URL, session=http_client.session)
+
+# The AI SDKs use httpx; give them pools as large as our own
+HTTP_POOL_SIZE = http_client.settings()["pool_size"]
+http_limits = httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
 
 # Initialize AI clients
 genai_client = None
 openai_client = None
 
-if AI_PROVIDER == "gemini":
-    genai_client = genai.Client(api_key=GEMINI_API_KEY)
-elif AI_PROVIDER == "openai":
+if "gemini" in PROVIDERS:
+    genai_client = genai.Client(
+        api_key=GEMINI_API_KEY,
+        http_options=types.HttpOptions(
+            client_args={"limits": http_limits},
+            async_client_args={"limits": http_limits}
+        )
+    )
+if "openai" in PROVIDERS:
     openai_client = OpenAI(
         api_key=OPENAI_API_KEY,
-        base_url=OPENAI_BASE_URL if OPENAI_BASE_URL else None
+        base_url=OPENAI_BASE_URL if OPENAI_BASE_URL else None,
+        http_client=DefaultHttpxClient(limits=http_limits)
     )
 
-print(f"Using AI provider: {AI_PROVIDER}")
-if AI_PROVIDER == "openai" and OPENAI_BASE_URL:
-    print(f"OpenAI base URL: {OPENAI_BASE_URL}")
+# --- Rate limits ---
+# Calls wait for quota here instead of failing once it is gone
+mastodon_limiter = RateLimiter("mastodon", MASTODON_RATE_LIMIT, window=300, reserve=QUOTA_RESERVE)
+http_client.session.limit_host(urlsplit(MASTODON_BASE_URL).hostname, mastodon_limiter)
+llm_limiters = {
+    "gemini": RateLimiter("gemini", GEMINI_RPM, tokens=GEMINI_TPM, reserve=QUOTA_RESERVE),
+    "openai": RateLimiter("openai", OPENAI_RPM, tokens=OPENAI_TPM, reserve=QUOTA_RESERVE),
+}
+SYSTEM_TOKENS = estimate_tokens(SYSTEM_INSTRUCTION)
+IMAGE_TOKENS = 258  # what Gemini counts for an image; OpenAI's low-detail images are in the same range
+
+def error_backoff(failures: int) -> float:
+    """Seconds to wait after `failures` intake errors in a row: until Mastodon quota is back, else 2, 4, 8... seconds."""
+    return max(mastodon_limiter.wait_time(), min(ERROR_BACKOFF_MAX, 2 ** failures))
+
+# --- Tracing ---
+# Every mention is one trace; its stages are spans in TRACE_FILE and histograms in mention_stage_seconds
+profiler = MentionProfiler(PROFILE_DIR)
+
+@contextmanager
+def stage(name: str, **attrs):
+    """Times one stage of a mention, as a span and in mention_stage_seconds."""
+    with metrics.timer("mention_stage_seconds", stage=name), tracing.span(name, **attrs) as fields:
+        yield fields
+
+@contextmanager
+def mention_trace(statuses):
+    """Traces (and, when armed, profiles) answering one batch of mentions."""
+    status = statuses[-1]
+    with tracing.trace("mention", status_ids=[str(s.id) for s in statuses], account=status.account.acct), \
+            profiler.profile(f"mention {status.id}"), \
+            metrics.timer("mention_stage_seconds", stage="total"):
+        yield
+
+@contextmanager
+def llm_round(provider: str, model: str):
+    """Times one LLM request, as a span and in llm_request_seconds."""
+    with metrics.timer("llm_request_seconds", provider=provider, model=model), \
+            tracing.span("llm", provider=provider, model=model):
+        yield
+
+def submit_traced(executor, fn, *args):
+    """executor.submit that runs `fn` in the caller's trace."""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+# Both providers' clients stay ready; the router picks, hedges and fails over per reply
+provider_router = ProviderRouter(
+    PROVIDERS,
+    hedge_after=LLM_HEDGE_AFTER,
+    failure_threshold=LLM_BREAKER_FAILURES,
+    cooldown=LLM_BREAKER_COOLDOWN,
+    workers=2 * WORKER_POOL_SIZE
+)
+
+log(f"Using AI provider: {AI_PROVIDER}")
+if len(PROVIDERS) > 1:
+    log(f"Fallback AI provider: {PROVIDERS[1]}")
+if "openai" in PROVIDERS and OPENAI_BASE_URL:
+    log(f"OpenAI base URL: {OPENAI_BASE_URL}")
 
 # --- Load/save persistent yaoi mode users ---
 def load_yaoi_mode_users() -> set:
@@ -75,180 +229,15 @@ def save_yaoi_mode_users(users: set):
         json.dump(list(users), f)
 
 yaoi_mode_users = load_yaoi_mode_users()
+yaoi_mode_lock = threading.Lock()  # mentions are handled on several worker threads
 
-# --- Function declarations ---
-# OpenAI format function definitions
-openai_functions = [
-    {
-        "type": "function",
-        "function": {
-            "name": "get_profile",
-            "description": "Gets the profile information for a Mastodon user by their account name.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "acct": {
-                        "type": "string",
-                        "description": "The account name of the user (e.g. 'username' or 'username@instance')"
-                    }
-                },
-                "required": ["acct"]
-            }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "get_post",
-            "description": "Retrieves a specific post (gort) from Mastodon by its ID.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "id": {
-                        "type": "string",
-                        "description": "The numeric ID of the post to retrieve"
-                    }
-                },
-                "required": ["id"]
-            }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "get_thread",
-            "description": "Retrieves the thread context (ancestors and descendants) for a given post ID.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "id": {
-                        "type": "string",
-                        "description": "The numeric ID of the post to get the thread context for"
-                    }
-                },
-                "required": ["id"]
-            }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "fetch_url",
-            "description": "Fetches the content of a URL and returns the text. Useful for retrieving web page content.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "url": {
-                        "type": "string",
-                        "description": "The URL to fetch content from"
-                    }
-                },
-                "required": ["url"]
-            }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "search_posts",
-            "description": "Searches for posts (gorts) containing specific hashtags or text.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "query": {
-                        "type": "string",
-                        "description": "The search query text or hashtag"
-                    },
-                    "limit": {
-                        "type": "integer",
-                        "description": "Maximum number of results to return (default: 5)"
-                    }
-                },
-                "required": ["query"]
-            }
-        }
-    }
-]
-
-# Gemini format function definitions
-get_profile_function = {
-    "name": "get_profile",
-    "description": "Gets the profile information for a Mastodon user by their account name.",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "acct": {
-                "type": "string",
-                "description": "The account name of the user (e.g. 'username' or 'username@instance')"
-            }
-        },
-        "required": ["acct"]
-    }
-}
-
-get_post_function = {
-    "name": "get_post",
-    "description": "Retrieves a specific post (gort) from Mastodon by its ID.",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "id": {
-                "type": "string",
-                "description": "The numeric ID of the post to retrieve"
-            }
-        },
-        "required": ["id"]
-    }
-}
-
-get_thread_function = {
-    "name": "get_thread",
-    "description": "Retrieves the thread context (ancestors and descendants) for a given post ID.",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "id": {
-                "type": "string",
-                "description": "The numeric ID of the post to get the thread context for"
-            }
-        },
-        "required": ["id"]
-    }
-}
-
-fetch_url_function = {
-    "name": "fetch_url",
-    "description": "Fetches the content of a URL and returns the text. Useful for retrieving web page content.",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "url": {
-                "type": "string",
-                "description": "The URL to fetch content from"
-            }
-        },
-        "required": ["url"]
-    }
-}
+# --- Thread cache ---
+# Shared by build_conversation and the get_thread tool; our own replies are added as we post them
+thread_store = ThreadStore(mastodon.status_context, ttl=THREAD_CACHE_TTL)
 
-search_posts_function = {
-    "name": "search_posts",
-    "description": "Searches for posts (gorts) containing specific hashtags or text.",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "query": {
-                "type": "string",
-                "description": "The search query text or hashtag"
-            },
-            "limit": {
-                "type": "integer",
-                "description": "Maximum number of results to return (default: 5)"
-            }
-        },
-        "required": ["query"]
-    }
-}
+# --- Page cache ---
+# Pages fetched by the fetch_url tool, revalidated with ETag/Last-Modified
+page_cache = PageCache(PAGE_CACHE_DIR)
 
 # --- Mastodon helper functions ---
 def get_profile(acct: str) -> dict:
@@ -256,18 +245,20 @@ def get_profile(acct: str) -> dict:
     try:
         users = mastodon.account_search(acct, limit=1)
         if not users:
-            return {"error": f"User '{acct}' not found."}
+            return {"error": f"User '{acct}' not found.", "not_found": True}
         user = mastodon.account(users[0].id)
         return {
             "id": user.id,
             "username": user.acct,
             "display_name": user.display_name,
-            "bio": re.sub(r'<[^>]+>', '', user.note),
+            "bio": html_to_text(user.note),
             "followers_count": user.followers_count,
             "following_count": user.following_count,
             "posts_count": user.statuses_count,
             "created_at": str(user.created_at)
         }
+    except MastodonNotFoundError as e:
+        return {"error": str(e), "not_found": True}
     except MastodonError as e:
         return {"error": str(e)}
 
@@ -275,7 +266,7 @@ def get_post(id: str) -> dict:
     """Gets a specific post by ID."""
     try:
         status = mastodon.status(id)
-        content = re.sub(r'<[^>]+>', '', status.content)
+        content = html_to_text(status.content)
         return {
             "id": status.id,
             "author": status.account.acct,
@@ -285,55 +276,167 @@ def get_post(id: str) -> dict:
             "reblogs_count": status.reblogs_count,
             "replies_count": status.replies_count
         }
+    except MastodonNotFoundError as e:
+        return {"error": str(e), "not_found": True}
     except MastodonError as e:
         return {"error": str(e)}
 
 def get_thread(id: str) -> dict:
     """Gets the thread context for a post."""
     try:
-        context = mastodon.status_context(id)
+        context = thread_store.context(id)
         
         def extract_post(status):
             return {
                 "id": status.id,
                 "author": status.account.acct,
-                "content": re.sub(r'<[^>]+>', '', status.content),
+                "content": html_to_text(status.content),
                 "created_at": str(status.created_at)
             }
             
         return {
-            "ancestors": [extract_post(s) for s in context.ancestors],
-            "descendants": [extract_post(s) for s in context.descendants]
+            "ancestors": [extract_post(s) for s in context["ancestors"]],
+            "descendants": [extract_post(s) for s in context["descendants"]]
         }
+    except MastodonNotFoundError as e:
+        return {"error": str(e), "not_found": True}
     except MastodonError as e:
         return {"error": str(e)}
 
+class PageTextReader:
+    """Turns a streamed response body into at most FETCH_URL_MAX_CHARS of page text."""
+
+    def __init__(self, content_type_header: str, charset: str = None):
+        # requests/httpx guess ISO-8859-1 without a charset; most pages are UTF-8
+        if "charset" not in content_type_header.lower():
+            charset = "utf-8"
+        self._decoder = codecs.getincrementaldecoder(charset or "utf-8")(errors="replace")
+        self._converter = HTMLTextConverter(collapse_whitespace=True)
+        self._bytes_read = 0
+        self.complete = True
+
+    def feed(self, chunk: bytes) -> bool:
+        """Consumes a chunk. Returns False once there is enough text to stop downloading."""
+        self._bytes_read += len(chunk)
+        self._converter.feed(self._decoder.decode(chunk))
+        # Stop downloading once we have enough text or hit the size cap
+        if (self._converter.length > FETCH_URL_MAX_CHARS and len(self._converter.text()) > FETCH_URL_MAX_CHARS) \
+                or self._bytes_read >= FETCH_URL_MAX_BYTES:
+            self.complete = False
+            return False
+        return True
+
+    def close(self) -> str:
+        if self.complete:
+            self._converter.feed(self._decoder.decode(b"", final=True))
+        clean_text = self._converter.close()
+        # Limit text length to avoid overloading the model
+        if len(clean_text) > FETCH_URL_MAX_CHARS or not self.complete:
+            clean_text = clean_text[:FETCH_URL_MAX_CHARS] + "... [content truncated]"
+        return clean_text
+
+def unsupported_content_type(headers) -> str:
+    """Returns the Content-Type if it isn't text we can read, otherwise None."""
+    content_type = headers.get("Content-Type", "").split(";")[0].strip().lower()
+    if content_type and not (content_type.startswith("text/") or content_type in TEXT_CONTENT_TYPES):
+        return content_type
+    return None
+
+def cache_page(url: str, status_code: int, headers, text: str) -> dict:
+    """Builds the fetch_url result and stores it in the page cache."""
+    result = {
+        "url": url,
+        "content": text,
+        "status_code": status_code
+    }
+    metrics.inc("page_cache_requests_total", result="miss")
+    page_cache.put(
+        url,
+        result,
+        etag=headers.get("ETag"),
+        last_modified=headers.get("Last-Modified")
+    )
+    return result
+
+def iter_body(response, chunk_size: int, deadline: float):
+    """Yields a streamed requests response body, raising TimeoutError once the monotonic `deadline` passes.
+
+    iter_content waits for a whole chunk, so a server trickling bytes would
+    never reach a deadline check between chunks; read1 returns whatever one
+    read got. The session's read timeout still bounds each read.
+    """
+    while True:
+        if time.monotonic() > deadline:
+            raise TimeoutError
+        chunk = response.raw.read1(chunk_size, decode_content=True)
+        if not chunk:
+            return
+        yield chunk
+
 def fetch_url(url: str) -> dict:
     """Fetches content from a URL."""
     try:
         headers = {
             "User-Agent": "mastodon-epic-gemini-bot/1.0"
         }
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        
-        # Try to extract main content using a simple approach
-        # For more sophisticated extraction, consider using libraries like newspaper3k
-        text = response.text
-        # Strip HTML tags for basic text extraction
-        clean_text = re.sub(r'<[^>]+>', ' ', text)
-        clean_text = re.sub(r'\s+', ' ', clean_text).strip()
-        
-        # Limit text length to avoid overloading the model
-        max_length = 2000
-        if len(clean_text) > max_length:
-            clean_text = clean_text[:max_length] + "... [content truncated]"
-        
-        return {
-            "url": url,
-            "content": clean_text,
-            "status_code": response.status_code
-        }
+        cached = page_cache.get(url)
+        if cached:
+            headers.update(page_cache.validators(cached))
+
+        deadline = time.monotonic() + FETCH_URL_TIMEOUT
+        with http_client.session.get(url, headers=headers, timeout=10, stream=True) as response:
+            if response.status_code == 304 and cached:
+                metrics.inc("page_cache_requests_total", result="revalidated")
+                page_cache.touch(url)
+                return cached["result"]
+            response.raise_for_status()
+
+            # Decide from the headers alone whether the body is worth reading
+            content_type = unsupported_content_type(response.headers)
+            if content_type:
+                return {"error": f"Unsupported content type: {content_type}"}
+
+            # Try to extract main content using a simple approach
+            # For more sophisticated extraction, consider using libraries like newspaper3k
+            reader = PageTextReader(response.headers.get("Content-Type", ""), response.encoding)
+            for chunk in iter_body(response, 16384, deadline):
+                if not reader.feed(chunk):
+                    break
+            return cache_page(url, response.status_code, response.headers, reader.close())
+    except TimeoutError:
+        return {"error": f"Failed to fetch URL: took longer than {FETCH_URL_TIMEOUT:g}s"}
+    except Exception as e:
+        return {"error": f"Failed to fetch URL: {str(e)}"}
+
+# Used by the async engine, which creates it inside its event loop
+async_http = None  # httpx.AsyncClient
+
+async def fetch_url_async(url: str) -> dict:
+    """fetch_url on the async HTTP client."""
+    try:
+        headers = {}
+        cached = page_cache.get(url)
+        if cached:
+            headers.update(page_cache.validators(cached))
+
+        async with asyncio.timeout(FETCH_URL_TIMEOUT), async_http.stream("GET", url, headers=headers, timeout=10) as response:
+            if response.status_code == 304 and cached:
+                metrics.inc("page_cache_requests_total", result="revalidated")
+                page_cache.touch(url)
+                return cached["result"]
+            response.raise_for_status()
+
+            content_type = unsupported_content_type(response.headers)
+            if content_type:
+                return {"error": f"Unsupported content type: {content_type}"}
+
+            reader = PageTextReader(response.headers.get("Content-Type", ""), response.charset_encoding)
+            async for chunk in response.aiter_bytes(16384):
+                if not reader.feed(chunk):
+                    break
+            return cache_page(url, response.status_code, response.headers, reader.close())
+    except TimeoutError:
+        return {"error": f"Failed to fetch URL: took longer than {FETCH_URL_TIMEOUT:g}s"}
     except Exception as e:
         return {"error": f"Failed to fetch URL: {str(e)}"}
 
@@ -354,7 +457,7 @@ def search_posts(query: str, limit: int = 5) -> dict:
             posts.append({
                 "id": status.id,
                 "author": status.account.acct,
-                "content": re.sub(r'<[^>]+>', '', status.content),
+                "content": html_to_text(status.content),
                 "created_at": str(status.created_at)
             })
             
@@ -366,47 +469,145 @@ def search_posts(query: str, limit: int = 5) -> dict:
     except MastodonError as e:
         return {"error": str(e)}
 
+# --- Tool registry ---
+# One definition per tool; provider schemas are generated from these at startup
+tools = ToolRegistry(TTLCache(maxsize=TOOL_CACHE_SIZE), negative_ttl=TOOL_CACHE_NEGATIVE_TTL, default_timeout=TOOL_TIMEOUT)
+
+tools.register(
+    "get_profile", get_profile,
+    "Gets the profile information for a Mastodon user by their account name.",
+    {"acct": {"type": "string", "description": "The account name of the user (e.g. 'username' or 'username@instance')"}},
+    required=["acct"],
+    cache_ttl=300,
+)
+tools.register(
+    "get_post", get_post,
+    "Retrieves a specific post (gort) from Mastodon by its ID.",
+    {"id": {"type": "string", "description": "The numeric ID of the post to retrieve"}},
+    required=["id"],
+    cache_ttl=60,
+)
+# Not cached here: the thread store already keeps threads fresh
+tools.register(
+    "get_thread", get_thread,
+    "Retrieves the thread context (ancestors and descendants) for a given post ID.",
+    {"id": {"type": "string", "description": "The numeric ID of the post to get the thread context for"}},
+    required=["id"],
+)
+# Not cached here: the page cache revalidates pages with the server instead
+tools.register(
+    "fetch_url", fetch_url,
+    "Fetches the content of a URL and returns the text. Useful for retrieving web page content.",
+    {"url": {"type": "string", "description": "The URL to fetch content from"}},
+    required=["url"],
+    timeout=20,
+    async_handler=fetch_url_async,
+)
+tools.register(
+    "search_posts", search_posts,
+    "Searches for posts (gorts) containing specific hashtags or text.",
+    {
+        "query": {"type": "string", "description": "The search query text or hashtag"},
+        "limit": {"type": "integer", "description": "Maximum number of results to return (default: 5)"},
+    },
+    required=["query"],
+    cache_ttl=60,
+)
+tools.freeze()
+
 def upload_image(path: str):
     """Uploads an image to Mastodon."""
     try:
         media = mastodon.media_post(path)
         return [media]
     except MastodonError as e:
-        print(f"Failed to upload image: {e}")
+        log(f"Failed to upload image: {e}", level="error")
         return []
 
+# Uploaded media for the yaoi image, reused while the file is unchanged
+media_cache = MediaCache(upload_image, mode=MEDIA_CACHE_MODE)
+image_pool = ImagePoolReader(YAOI_POOL_DIR, fallback=YAOI_FALLBACK_IMAGE)
+
+def get_yaoi_media(prefetch=True) -> list:
+    """Uploads (or takes from the cache) the next image from the pool."""
+    image_path = image_pool.next()
+    if image_path is None:
+        log(f"No yaoi image available in {YAOI_POOL_DIR}", level="warning")
+        return []
+    # Pre-upload the image the next reply will get rather than this one again
+    return media_cache.get(image_path, upcoming=image_pool.peek(), prefetch=prefetch)
+
 # --- Image utility ---
-def get_image_bytes(url: str) -> bytes:
-    """Downloads image bytes from a URL."""
-    resp = requests.get(url)
-    resp.raise_for_status()
-    return resp.content
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_POOL_SIZE, thread_name_prefix="image")
+
+class ByteBudget:
+    """A byte allowance shared by the downloads of one mention."""
+
+    def __init__(self, limit: int):
+        self.remaining = limit
+        self._lock = threading.Lock()
+
+    def take(self, count: int) -> bool:
+        with self._lock:
+            if count > self.remaining:
+                return False
+            self.remaining -= count
+            return True
+
+    def close(self):
+        """Makes downloads still running on this budget fail at their next chunk."""
+        with self._lock:
+            self.remaining = -1
+
+def get_image_bytes(url: str, budget: ByteBudget = None) -> tuple:
+    """Downloads an image, returning (bytes, mime type)."""
+    deadline = time.monotonic() + IMAGE_DOWNLOAD_TIMEOUT
+    with stage("image_download"), \
+            http_client.session.get(url, timeout=IMAGE_DOWNLOAD_TIMEOUT, stream=True) as resp:
+        resp.raise_for_status()
+        mime_type = resp.headers.get("Content-Type", "image/jpeg").split(";")[0].strip()
+        chunks = []
+        try:
+            for chunk in iter_body(resp, 65536, deadline):
+                if budget is not None and not budget.take(len(chunk)):
+                    raise ValueError("image byte budget exceeded")
+                chunks.append(chunk)
+        except TimeoutError:
+            raise TimeoutError(f"download took longer than {IMAGE_DOWNLOAD_TIMEOUT}s") from None
+    return b"".join(chunks), mime_type
+
+def prefetch_images(image_urls: list, budget: ByteBudget = None) -> list:
+    """Starts downloading all images in parallel. Returns one future per URL."""
+    budget = budget or ByteBudget(IMAGE_MAX_TOTAL_BYTES)
+    return [submit_traced(image_executor, get_image_bytes, url, budget) for url in image_urls]
 
 # --- Conversation building ---
+prompt_builder = PromptBuilder(budget=PROMPT_TOKEN_BUDGET, keep_recent=PROMPT_RECENT_TURNS)
+
 def clean_content(html_content, bot_acct):
     """Cleans HTML content and removes bot mentions."""
-    text = re.sub(r'<[^>]+>', '', html_content)
-    text = html.unescape(text)
-    text = re.sub(rf"@{re.escape(bot_acct)}", '', text, flags=re.IGNORECASE).strip()
-    return text
+    return html_to_text(html_content, bot_acct=bot_acct)
+
+def conversation_turn(status, bot_acct) -> tuple:
+    """(key, author, text) of one status, for the prompt builder."""
+    key = (str(status.id), str(getattr(status, "edited_at", None)))
+    return key, status.account.acct, clean_content(status.content, bot_acct)
 
 def build_conversation(status, bot_acct):
-    """Builds a conversation history from status context."""
-    context = mastodon.status_context(status.id)
-    convo = []
-    
-    # Add ancestors (previous messages in thread)
-    for ancestor in context['ancestors']:
-        author = ancestor.account.acct
-        text = clean_content(ancestor.content, bot_acct)
-        convo.append(f"{author}: {text}")
-    
-    # Add current message
-    current_author = status.account.acct
-    current_text = clean_content(status.content, bot_acct)
-    convo.append(f"{current_author}: {current_text}")
-    
-    return "\n".join(convo)
+    """Builds a conversation history from status context, within PROMPT_TOKEN_BUDGET."""
+    # Ancestors (previous messages in thread), then the current message
+    with stage("context") as span:
+        ancestors = thread_store.ancestors(status)
+        span["posts"] = len(ancestors) + 1
+    turns = [conversation_turn(ancestor, bot_acct) for ancestor in ancestors]
+    turns.append(conversation_turn(status, bot_acct))
+
+    convo, summarized, dropped = prompt_builder.build(turns)
+    if summarized or dropped:
+        log(f"Thread of {len(turns)} posts over the prompt budget: summarized {summarized}, skipped {dropped}")
+        metrics.inc("prompt_turns_summarized_total", summarized)
+        metrics.inc("prompt_turns_dropped_total", dropped)
+    return convo
 
 def extract_urls(text):
     """Extracts URLs from text."""
@@ -414,24 +615,72 @@ def extract_urls(text):
     return re.findall(url_pattern, text)
 
 # --- Function calling helpers ---
-def execute_function(fn_name: str, fn_args: dict) -> dict:
-    """Execute a function call and return the result."""
-    if fn_name == "get_profile":
-        return get_profile(**fn_args)
-    elif fn_name == "get_post":
-        return get_post(**fn_args)
-    elif fn_name == "get_thread":
-        return get_thread(**fn_args)
-    elif fn_name == "fetch_url":
-        return fetch_url(**fn_args)
-    elif fn_name == "search_posts":
-        return search_posts(**fn_args)
-    else:
-        return {"error": f"Unknown function: {fn_name}"}
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_POOL_SIZE, thread_name_prefix="tool")
+
+def split_parallel(calls: list) -> tuple:
+    """Splits one turn's calls into (index, name, args) that may overlap and those that may not."""
+    parallel, serial = [], []
+    for i, (fn_name, fn_args) in enumerate(calls):
+        tool = tools.get(fn_name)
+        (serial if tool and not tool.parallel else parallel).append((i, fn_name, fn_args))
+    return parallel, serial
+
+def tool_error(fn_name: str, error: Exception) -> dict:
+    if isinstance(error, (FuturesTimeoutError, asyncio.TimeoutError)):
+        timeout = tools.timeout(fn_name)
+        log(f"Function call {fn_name} timed out after {timeout}s", level="warning")
+        return {"error": f"{fn_name} timed out after {timeout} seconds"}
+    return {"error": f"{fn_name} failed: {error}"}
+
+def run_tool(fn_name: str, fn_args: dict) -> dict:
+    """Runs a tool call; its Mastodon lookups leave the quota reserve to replies."""
+    with background(), tracing.span("tool", tool=fn_name):
+        return tools.execute(fn_name, fn_args)
+
+def execute_functions(calls: list) -> list:
+    """Runs all (name, args) tool calls of one model turn concurrently.
+
+    Results come back in the same order as `calls`. A call that doesn't finish
+    within its tool's timeout is reported to the model as an error. Tools that
+    may not run in parallel run one at a time after the others.
+    """
+    parallel, serial = split_parallel(calls)
+    results = [None] * len(calls)
+
+    started = time.monotonic()
+    futures = [(i, fn_name, submit_traced(tool_executor, run_tool, fn_name, fn_args)) for i, fn_name, fn_args in parallel]
+    for i, fn_name, future in futures:
+        try:
+            results[i] = future.result(timeout=max(0, tools.timeout(fn_name) - (time.monotonic() - started)))
+        except Exception as e:
+            future.cancel()
+            results[i] = tool_error(fn_name, e)
+
+    for i, fn_name, fn_args in serial:
+        future = submit_traced(tool_executor, run_tool, fn_name, fn_args)
+        try:
+            results[i] = future.result(timeout=tools.timeout(fn_name))
+        except Exception as e:
+            results[i] = tool_error(fn_name, e)
+    return results
+
+# --- Reply tiers ---
+# Most capable first; under load new replies move down the list. `full` has no output cap
+TIERS = [
+    Tier("full", GEMINI_MODEL, OPENAI_MODEL, max_tokens=None, max_tool_rounds=3),
+    Tier("fast", GEMINI_FAST_MODEL, OPENAI_FAST_MODEL, max_tokens=600, max_tool_rounds=1),
+    Tier("lean", GEMINI_FAST_MODEL, OPENAI_FAST_MODEL, max_tokens=300, max_tool_rounds=0),
+]
+tier_policy = TierPolicy(
+    TIERS if TIER_QUEUE_PRESSURE else TIERS[:1],
+    queue_pressure=TIER_QUEUE_PRESSURE,
+    latency_pressure=TIER_LATENCY_PRESSURE,
+    dwell=TIER_DWELL
+)
 
 # --- OpenAI reply generation ---
-def generate_reply_openai(prompt: str, image_urls: list[str] = None) -> str:
-    """Generates a reply using OpenAI API with function calling capabilities."""
+def openai_messages(prompt: str, image_urls: list[str] = None) -> list:
+    """Builds the initial OpenAI messages for a prompt and its images."""
     messages = [
         {"role": "system", "content": SYSTEM_INSTRUCTION},
     ]
@@ -445,37 +694,127 @@ def generate_reply_openai(prompt: str, image_urls: list[str] = None) -> str:
     # Add images if available
     if image_urls:
         for img_url in image_urls:
-            try:
-                user_content.append({
-                    "type": "image_url",
-                    "image_url": {"url": img_url}
-                })
-            except Exception as e:
-                print(f"Failed to add image {img_url}: {e}")
-                continue
+            user_content.append({
+                "type": "image_url",
+                "image_url": {"url": img_url}
+            })
     
     messages.append({"role": "user", "content": user_content})
+    return messages
+
+def openai_request(messages: list, tier: Tier) -> dict:
+    """Arguments for chat.completions.create, shared by the sync and async clients.
+
+    The tools and system message come first and never change, so the serialized
+    prefix is byte-identical across requests and providers' automatic prefix
+    caching can reuse it. Keep anything per-request out of SYSTEM_INSTRUCTION.
+    Tiers without tool rounds still send the tools, but with tool_choice "none".
+    """
+    request = {
+        "model": tier.openai_model,
+        "messages": messages,
+        "tools": tools.openai_schemas,
+        "tool_choice": "auto" if tier.max_tool_rounds else "none",
+    }
+    if tier.max_tokens:
+        request["max_tokens"] = tier.max_tokens
+    if OPENAI_PROMPT_CACHE_KEY:
+        request["prompt_cache_key"] = OPENAI_PROMPT_CACHE_KEY
+    return request
+
+def record_token_usage(provider: str, model: str, prompt_tokens: int, cached_tokens: int, output_tokens: int):
+    """Counts input tokens served from the provider's prompt cache vs. sent in full, and output tokens."""
+    cached_tokens = cached_tokens or 0
+    labels = {"provider": provider, "model": model}
+    metrics.inc("llm_input_tokens_total", cached_tokens, cache="cached", **labels)
+    metrics.inc("llm_input_tokens_total", max(0, (prompt_tokens or 0) - cached_tokens), cache="uncached", **labels)
+    metrics.inc("llm_output_tokens_total", output_tokens or 0, **labels)
+
+def record_openai_usage(response, model: str):
+    """Records token metrics. Returns the total tokens the request used, or None."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return None
+    details = getattr(usage, "prompt_tokens_details", None)
+    record_token_usage("openai", model, usage.prompt_tokens, getattr(details, "cached_tokens", 0), usage.completion_tokens)
+    return usage.total_tokens
+
+def openai_request_tokens(request: dict) -> int:
+    """Estimated tokens of a request for the quota; OpenAI counts max_tokens up front too, when it is set."""
+    tokens = request.get("max_tokens", 0)
+    for message in request["messages"]:
+        content = message.get("content") if isinstance(message, dict) else str(message)
+        if isinstance(content, list):
+            tokens += sum(estimate_tokens(part["text"]) if part["type"] == "text" else IMAGE_TOKENS for part in content)
+        else:
+            tokens += estimate_tokens(content or "")
+    return tokens
+
+def openai_create(messages: list, tier: Tier):
+    """chat.completions.create, waiting for OpenAI quota first."""
+    request = openai_request(messages, tier)
+    estimate = openai_request_tokens(request)
+    limiter = llm_limiters["openai"]
+    limiter.acquire(estimate)
+    try:
+        with llm_round("openai", request["model"]):
+            response = openai_client.chat.completions.create(**request)
+    except RateLimitError as e:
+        limiter.hold(retry_after(e))
+        raise
+    limiter.settle(estimate, record_openai_usage(response, request["model"]))
+    return response
+
+def openai_tool_calls(assistant_message) -> list:
+    """Returns the (name, args) of every tool call in an assistant message."""
+    calls = []
+    for tool_call in assistant_message.tool_calls:
+        fn_name = tool_call.function.name
+        try:
+            fn_args = json.loads(tool_call.function.arguments or "{}")
+        except json.JSONDecodeError:
+            fn_args = {}
+        log(f"Function call: {fn_name} with args: {fn_args}")
+        calls.append((fn_name, fn_args))
+    return calls
+
+def openai_tool_results(assistant_message, results: list) -> list:
+    """Tool result messages, in the order the model asked for them."""
+    return [
+        {
+            "role": "tool",
+            "tool_call_id": tool_call.id,
+            "content": json.dumps(result)
+        }
+        for tool_call, result in zip(assistant_message.tool_calls, results)
+    ]
+
+def openai_final_text(assistant_message, calls_made: int, max_calls: int) -> str:
+    """The reply text once the function calling loop has ended."""
+    final_content = assistant_message.content if assistant_message.content else ""
+    if calls_made >= max_calls and assistant_message.tool_calls:
+        final_content = "I've gathered some information but reached my function call limit. " + final_content
+    return final_content.strip()
+
+def generate_reply_openai(prompt: str, image_urls: list[str] = None, tier: Tier = TIERS[0]) -> str:
+    """Generates a reply using OpenAI API with function calling capabilities."""
+    messages = openai_messages(prompt, image_urls)
     
     # Initial call to the model
-    response = openai_client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=messages,
-        tools=openai_functions,
-        tool_choice="auto",
-        max_tokens=1000
-    )
+    response = openai_create(messages, tier)
     
     message = response.choices[0].message
     
     # Check if the response contains tool calls
     if message.tool_calls:
-        return handle_openai_function_calls(messages, message, max_calls=3)
+        return handle_openai_function_calls(messages, message, tier)
     else:
         # Direct text response
         return message.content.strip() if message.content else ""
 
-def handle_openai_function_calls(messages: list, assistant_message, max_calls=3):
-    """Handles function calls from OpenAI, possibly with multiple rounds."""
+def handle_openai_function_calls(messages: list, assistant_message, tier: Tier):
+    """Handles function calls from OpenAI, with up to the tier's number of rounds."""
+    max_calls = tier.max_tool_rounds
     calls_made = 0
     current_messages = messages.copy()
     current_messages.append(assistant_message)
@@ -483,201 +822,929 @@ def handle_openai_function_calls(messages: list, assistant_message, max_calls=3)
     while calls_made < max_calls and assistant_message.tool_calls:
         calls_made += 1
         
-        # Execute each tool call
-        for tool_call in assistant_message.tool_calls:
-            fn_name = tool_call.function.name
-            fn_args = json.loads(tool_call.function.arguments)
-            
-            print(f"Function call: {fn_name} with args: {fn_args}")
-            
-            # Execute the function
-            result = execute_function(fn_name, fn_args)
-            
-            # Add function result to messages
-            current_messages.append({
-                "role": "tool",
-                "tool_call_id": tool_call.id,
-                "content": json.dumps(result)
-            })
+        # Execute all tool calls of this turn together
+        calls = openai_tool_calls(assistant_message)
+        results = execute_functions(calls)
+        current_messages.extend(openai_tool_results(assistant_message, results))
         
         # Get next response from model
-        response = openai_client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=current_messages,
-            tools=openai_functions,
-            tool_choice="auto",
-            max_tokens=1000
-        )
+        response = openai_create(current_messages, tier)
         
         assistant_message = response.choices[0].message
         current_messages.append(assistant_message)
-        
-        # Check if there are more tool calls or if we have a final text response
-        if not assistant_message.tool_calls:
-            return assistant_message.content.strip() if assistant_message.content else ""
     
-    # If we hit the max function calls limit or no more tool calls
-    final_content = assistant_message.content if assistant_message.content else ""
-    if calls_made >= max_calls and assistant_message.tool_calls:
-        final_content = "I've gathered some information but reached my function call limit. " + final_content
-    
-    return final_content.strip()
+    # Either a final text response or we hit the max function calls limit
+    return openai_final_text(assistant_message, calls_made, max_calls)
 
 # --- Gemini reply generation ---
-def generate_reply_gemini(prompt: str, image_urls: list[str] = None) -> str:
-    """Generates a reply using Gemini API with function calling capabilities."""
+# The system instruction and tools are the same for every request, so they live in a context cache.
+# A cache only works with the model it was made for, so each tier's model gets its own
+gemini_context_caches = {
+    model: GeminiContextCache(
+        genai_client,
+        model,
+        SYSTEM_INSTRUCTION,
+        tools.gemini_tools,
+        ttl=GEMINI_CACHE_TTL,
+        enabled=GEMINI_CONTEXT_CACHE and genai_client is not None
+    )
+    for model in {tier.gemini_model for tier in TIERS}
+}
+
+# Tool-less requests can't use the cache, which holds the tools
+gemini_toolless_configs = {
+    tier.name: types.GenerateContentConfig(system_instruction=SYSTEM_INSTRUCTION, max_output_tokens=tier.max_tokens)
+    for tier in TIERS
+    if not tier.max_tool_rounds
+}
+
+def gemini_config(tier: Tier = TIERS[0]):
+    """System instruction, tool declarations and output limit of a Gemini request in `tier`."""
+    if not tier.max_tool_rounds:
+        return gemini_toolless_configs[tier.name]
+    return gemini_context_caches[tier.gemini_model].config(tier.max_tokens)
+
+def record_gemini_usage(response, model: str):
+    """Records token metrics. Returns the total tokens the request used, or None."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return None
+    record_token_usage(
+        "gemini", model, usage.prompt_token_count, usage.cached_content_token_count, usage.candidates_token_count
+    )
+    return usage.total_token_count
+
+def gemini_request_tokens(contents: list) -> int:
+    """Estimated input tokens of a request for the quota; cached tokens still count against it."""
+    tokens = SYSTEM_TOKENS
+    for content in contents:
+        for part in content.parts or ():
+            if part.inline_data:
+                tokens += IMAGE_TOKENS
+            else:
+                tokens += estimate_tokens(part.text or str(part.function_call or part.function_response or ""))
+    return tokens
+
+def is_stale_cache_error(config, error) -> bool:
+    """True if a request failed because its context cache expired or was deleted."""
+    return bool(config.cached_content) and error.code in (400, 403, 404) and "cache" in str(error).lower()
+
+def gemini_generate(contents: list, config, model: str) -> tuple:
+    """Calls generate_content within the Gemini quota, retrying inline if the context cache went away.
+
+    Returns (response, config).
+    """
+    estimate = gemini_request_tokens(contents)
+    limiter = llm_limiters["gemini"]
+    limiter.acquire(estimate)
+    try:
+        with llm_round("gemini", model):
+            response = genai_client.models.generate_content(model=model, contents=contents, config=config)
+    except genai_errors.ClientError as e:
+        if e.code == 429:
+            limiter.hold(retry_after(e))
+        if not is_stale_cache_error(config, e):
+            raise
+        cache = gemini_context_caches[model]
+        cache.invalidate(config.cached_content)
+        config = cache.inline_config(config.max_output_tokens)
+        with llm_round("gemini", model):
+            response = genai_client.models.generate_content(model=model, contents=contents, config=config)
+    limiter.settle(estimate, record_gemini_usage(response, model))
+    return response, config
+
+def gemini_image_part(image: tuple):
+    """Turns a downloaded (bytes, mime type) image into a Gemini part."""
+    img_bytes, mime_type = image
+    return types.Part.from_bytes(
+        data=img_bytes,
+        mime_type=mime_type,
+    )
+
+def generate_reply_gemini(prompt: str, image_urls: list[str] = None, images: list = None, tier: Tier = TIERS[0]) -> str:
+    """Generates a reply using Gemini API with function calling capabilities.
+
+    `images` are futures from prefetch_images; if not given, downloads start here.
+    """
     contents = []
     
     # Add images if available
     if image_urls:
-        for img_url in image_urls:
+        if images is None:
+            images = prefetch_images(image_urls)
+        for img_url, image in zip(image_urls, images):
             try:
-                img_bytes = get_image_bytes(img_url)
-                contents.append(
-                    types.Part.from_bytes(
-                        data=img_bytes,
-                        mime_type='image/jpeg',
-                    )
-                )
+                contents.append(gemini_image_part(image.result(timeout=IMAGE_DOWNLOAD_TIMEOUT)))
             except Exception as e:
-                print(f"Failed to process image {img_url}: {e}")
+                log(f"Failed to process image {img_url}: {e}", level="error")
                 continue
     
     # Add the user prompt
     contents.append(types.Content(role="user", parts=[types.Part(text=prompt)]))
-    
-    # Set up function declarations as tools
-    tools = [
-        types.Tool(function_declarations=[get_profile_function]),
-        types.Tool(function_declarations=[get_post_function]),
-        types.Tool(function_declarations=[get_thread_function]),
-        types.Tool(function_declarations=[fetch_url_function]),
-        types.Tool(function_declarations=[search_posts_function])
-    ]
-    
-    # Create config with system instruction and tools
-    config = types.GenerateContentConfig(
-        system_instruction=SYSTEM_INSTRUCTION,
-        tools=tools
-    )
+    config = gemini_config(tier)
     
     # Initial call to the model
-    response = genai_client.models.generate_content(
-        model=GEMINI_MODEL,
-        contents=contents,
-        config=config
-    )
+    response, config = gemini_generate(contents, config, tier.gemini_model)
     
-    # Check if the response contains a function call
-    part = response.candidates[0].content.parts[0]
-    if hasattr(part, 'function_call') and part.function_call:
-        return handle_gemini_function_call(part.function_call, contents, config)
+    # Check if the response contains function calls
+    model_content = response.candidates[0].content
+    if gemini_function_calls(model_content):
+        return handle_gemini_function_call(model_content, contents, config, tier)
     else:
         # Direct text response
-        return part.text.strip()
+        return gemini_text(model_content)
+
+def gemini_function_calls(content) -> list:
+    """Returns every function call part in a Gemini response content."""
+    return [part.function_call for part in (content.parts or []) if part.function_call]
+
+def gemini_text(content) -> str:
+    """Returns the text parts of a Gemini response content."""
+    return "".join(part.text for part in (content.parts or []) if part.text).strip()
+
+def gemini_function_args(function_call) -> dict:
+    """Extracts the arguments of a Gemini function call."""
+    if not function_call.args:
+        return {}
+    if isinstance(function_call.args, dict):
+        return function_call.args
+    # Parse JSON string if necessary
+    return json.loads(function_call.args)
+
+def gemini_tool_calls(model_content) -> list:
+    """Returns the (name, args) of every function call the model made this turn."""
+    calls = []
+    for function_call in gemini_function_calls(model_content):
+        fn_args = gemini_function_args(function_call)
+        log(f"Function call: {function_call.name} with args: {fn_args}")
+        calls.append((function_call.name, fn_args))
+    return calls
 
-def handle_gemini_function_call(function_call, contents, config, max_calls=3):
-    """Handles function calls from Gemini, possibly with multiple rounds."""
+def gemini_tool_results(calls: list, results: list):
+    """All function responses of one turn, as a single user content."""
+    return types.Content(role="user", parts=[
+        types.Part.from_function_response(name=fn_name, response=result)
+        for (fn_name, _), result in zip(calls, results)
+    ])
+
+GEMINI_LIMIT_PREFIX = "I've gathered some information but reached my function call limit. Here's what I found: "
+
+def handle_gemini_function_call(model_content, contents, config, tier: Tier):
+    """Handles function calls from Gemini, with up to the tier's number of rounds."""
+    max_calls = tier.max_tool_rounds
     calls_made = 0
     current_contents = contents.copy()
     
     while calls_made < max_calls:
         calls_made += 1
         
-        # Extract function name and arguments
-        fn_name = function_call.name
-        fn_args = {}
-        if hasattr(function_call, 'args'):
-            if isinstance(function_call.args, dict):
-                fn_args = function_call.args
-            else:
-                # Parse JSON string if necessary
-                fn_args = json.loads(function_call.args)
-        
-        print(f"Function call: {fn_name} with args: {fn_args}")
-        
-        # Execute the function
-        result = execute_function(fn_name, fn_args)
+        # Execute every function call of this turn together
+        calls = gemini_tool_calls(model_content)
+        results = execute_functions(calls)
         
-        # Add function call and response to the conversation
-        current_contents.append(types.Content(role="assistant", parts=[types.Part(function_call=function_call)]))
-        current_contents.append(types.Content(role="function", parts=[types.Part.from_function_response(name=fn_name, response=result)]))
+        # Add the model's turn and all function responses to the conversation
+        current_contents.append(model_content)
+        current_contents.append(gemini_tool_results(calls, results))
         
         # Get final or next response from model
-        final_response = genai_client.models.generate_content(
-            model=GEMINI_MODEL,
-            contents=current_contents,
-            config=config
-        )
+        final_response, config = gemini_generate(current_contents, config, tier.gemini_model)
         
-        # Check if there's another function call or a final text response
-        part = final_response.candidates[0].content.parts[0]
-        if hasattr(part, 'function_call') and part.function_call:
-            # Another function call is needed
-            function_call = part.function_call
-        else:
+        # Check if there are more function calls or a final text response
+        model_content = final_response.candidates[0].content
+        if not gemini_function_calls(model_content):
             # We have a text response, return it
-            return part.text.strip()
+            return gemini_text(model_content)
     
     # If we hit the max function calls limit, just return what we got
-    return "I've gathered some information but reached my function call limit. Here's what I found: " + final_response.text.strip()
+    return GEMINI_LIMIT_PREFIX + gemini_text(model_content)
 
 # --- Unified reply generation ---
-def generate_reply(prompt: str, image_urls: list[str] = None) -> str:
-    """Generates a reply using the configured AI provider."""
-    if AI_PROVIDER == "gemini":
-        return generate_reply_gemini(prompt, image_urls)
-    elif AI_PROVIDER == "openai":
-        return generate_reply_openai(prompt, image_urls)
-    else:
-        raise ValueError(f"Unknown AI provider: {AI_PROVIDER}")
+def generate_reply(prompt: str, image_urls: list[str] = None, images: list = None) -> str:
+    """Generates a reply on the configured AI provider, hedged and failed over by the provider router.
+
+    The tier (model, output and tool limits) is picked from the current load.
+    """
+    tier = tier_policy.current()
+    started = time.monotonic()
+    with stage("generate", tier=tier.name):
+        reply = provider_router.call({
+            "gemini": lambda: generate_reply_gemini(prompt, image_urls, images, tier),
+            "openai": lambda: generate_reply_openai(prompt, image_urls, tier),
+        })
+    tier_policy.record(time.monotonic() - started)
+    return reply
 
 def post_yaoi_of_the_day():
     """Posts a single yaoi-of-the-day post with the image."""
-    print("Posting yaoi-of-the-day...")
+    log("Posting yaoi-of-the-day...")
     
     # Generate a prompt for the AI
     prompt = "start your response with 'yaoi of the day:' and then write 3-5 sentences about the image in character. keep it brief and fun!"
     
-    # Get the image
-    image_path = "./image.png"
-    if not os.path.exists(image_path):
-        print(f"Error: {image_path} not found!")
-        return
-    
-    # Upload the image
-    media = upload_image(image_path)
+    # Get and upload the image; the process exits right after, so no spare upload for a next post
+    media = get_yaoi_media(prefetch=False)
     if not media:
-        print("Failed to upload image")
+        log("Failed to upload image", level="error")
         return
     
     # Generate reply with AI
-    print(f"Generating reply with {AI_PROVIDER.upper()}...")
+    log(f"Generating reply with {AI_PROVIDER.upper()}...")
     # Pass the local file path directly instead of trying to use it as a URL
     reply = generate_reply(prompt)
     
     if reply:
         # Post the yaoi-of-the-day
-        print(f"Posting yaoi-of-the-day: {reply[:50]}...")
+        log(f"Posting yaoi-of-the-day: {reply[:50]}...")
         mastodon.status_post(
             status=reply,
             media_ids=[m.id for m in media],
             visibility="unlisted"  # Using unlisted visibility for yaoi-of-the-day
         )
-        print("Yaoi-of-the-day posted successfully!")
+        log("Yaoi-of-the-day posted successfully!")
     else:
-        print("No reply generated for yaoi-of-the-day")
+        log("No reply generated for yaoi-of-the-day")
+
+# --- Thread ordering ---
+THREAD_KEY_LIMIT = 10000
+thread_keys = OrderedDict()  # status id -> thread key
+thread_keys_lock = threading.Lock()
+
+def remember_thread(status_id, key):
+    """Records which thread a status belongs to."""
+    with thread_keys_lock:
+        thread_keys[status_id] = key
+        thread_keys.move_to_end(status_id)
+        while len(thread_keys) > THREAD_KEY_LIMIT:
+            thread_keys.popitem(last=False)
+
+def thread_key(status):
+    """Returns a key shared by every status we have seen in the same thread."""
+    parent = getattr(status, "in_reply_to_id", None)
+    with thread_keys_lock:
+        key = thread_keys.get(parent) if parent else None
+    if key is None:
+        key = parent or status.id
+    remember_thread(status.id, key)
+    return key
+
+# --- Mention handling ---
+def mention_status(note, bot_acct):
+    """Returns the status of a mention we should answer, or None."""
+    # make absolutely sure we're dealing with a mention
+    if note.type != "mention":
+        return None
+    # safely get status (won't blow up if it's missing)
+    status = getattr(note, "status", None)
+    if not status or status.account.acct.lower() == bot_acct.lower():
+        return None
+    return status
+
+def image_attachment_urls(status) -> list:
+    """Returns the URLs of the images attached to a status."""
+    image_urls = []
+    for media in status.media_attachments or []:
+        if getattr(media, "type", "image") != "image":
+            continue
+        url = getattr(media, 'url', None) or media.get('preview_url')
+        if url:
+            image_urls.append(url)
+    if image_urls:
+        log(f"Found {len(image_urls)} attached images")
+    return image_urls
+
+def handle_yaoi_toggle(status, user_acct, key, content_text) -> bool:
+    """Answers "enable/disable yaoi mode". Returns True if the mention was one of those."""
+    if "enable yaoi mode" in content_text:
+        with yaoi_mode_lock:
+            yaoi_mode_users.add(user_acct)
+            save_yaoi_mode_users(yaoi_mode_users)
+        media = get_yaoi_media()
+        posted = mastodon.status_post(
+            status=f"@{user_acct} Yaoi mode enabled just for you. 🌸",
+            media_ids=[m.id for m in media],
+            in_reply_to_id=status.id,
+            visibility=status.visibility
+        )
+        remember_thread(posted.id, key)
+        thread_store.add(posted)
+        log(f"Enabled yaoi mode for @{user_acct}")
+        return True
+
+    if "disable yaoi mode" in content_text:
+        with yaoi_mode_lock:
+            yaoi_mode_users.discard(user_acct)
+            save_yaoi_mode_users(yaoi_mode_users)
+        posted = mastodon.status_post(
+            status=f"@{user_acct} Yaoi mode disabled for you. 💔",
+            in_reply_to_id=status.id,
+            visibility=status.visibility
+        )
+        remember_thread(posted.id, key)
+        thread_store.add(posted)
+        log(f"Disabled yaoi mode for @{user_acct}")
+        return True
+
+    return False
+
+def conversation_prompt(convo: str, also_mentioned: list = None) -> str:
+    """Generates the prompt for a conversation.
+
+    `also_mentioned` are lines for other new mentions in the thread that are
+    not part of `convo`; the model is asked to answer them in the same reply.
+    """
+    # Check for URLs in the content for potential function calls
+    urls = extract_urls(convo.lower())
+    if urls:
+        log(f"Found URLs in content: {urls}")
+
+    if also_mentioned:
+        others = "\n".join(also_mentioned)
+        return (f"CONVERSATION:\n{convo}\nALSO MENTIONED YOU IN THIS THREAD:\n{others}\n"
+                f"(write one reply that answers all of them)\nBot:")
+    return f"CONVERSATION:\n{convo}\nBot:"
+
+def post_reply(status, user_acct, key, reply, also_mention=()):
+    """Posts a generated reply, with a yaoi image for users in yaoi mode.
+
+    `also_mention` are other accounts the reply answers; they are mentioned too.
+    """
+    if not reply:
+        log("No reply generated")
+        return
+
+    # Determine reply visibility: convert any public to unlisted
+    reply_visibility = "unlisted" if status.visibility == "public" else status.visibility
+    media_ids = []
+    if user_acct in yaoi_mode_users:
+        log(f"Adding yaoi mode image for @{user_acct}")
+        with stage("media_post"):
+            media = get_yaoi_media()
+        media_ids = [m.id for m in media]
+
+    log(f"Posting reply (visibility={reply_visibility}): {reply[:50]}...")
+    mentions = " ".join(f"@{acct}" for acct in dict.fromkeys([user_acct, *also_mention]))
+    with stage("status_post", visibility=reply_visibility):
+        posted = mastodon.status_post(
+            status=f"{mentions} {reply}",
+            in_reply_to_id=status.id,
+            media_ids=media_ids,
+            visibility=reply_visibility
+        )
+    # Follow-ups to our own reply belong to the same thread
+    remember_thread(posted.id, key)
+    thread_store.add(posted)
+    log("Reply posted successfully")
+
+def mention_batches(notes, bot_acct) -> list:
+    """Splits the mentions of one thread into groups that can share a reply.
+
+    Mentions are only combined with others of the same visibility, so nothing
+    from a private post ends up in a more public reply, and private and direct
+    mentions are only combined with ones from the same account, so nobody's
+    followers-only post or DM reaches another sender. Yaoi mode commands in a
+    combined batch are answered on their own.
+    """
+    statuses = [status for status in (mention_status(note, bot_acct) for note in notes) if status is not None]
+    if len(statuses) <= 1:
+        return [statuses] if statuses else []
+
+    commands, groups = [], OrderedDict()
+    for status in statuses:
+        text = clean_content(status.content, bot_acct).lower()
+        if "enable yaoi mode" in text or "disable yaoi mode" in text:
+            commands.append([status])
+        else:
+            shared = status.visibility in ("public", "unlisted")
+            group = status.visibility if shared else (status.visibility, status.account.acct)
+            groups.setdefault(group, []).append(status)
+    return commands + list(groups.values())
+
+def batch_context(statuses, bot_acct) -> tuple:
+    """Returns (newest status, other authors, lines for mentions the newest one's thread doesn't show)."""
+    newest = statuses[-1]
+    if len(statuses) == 1:
+        return newest, [], []
+    ancestor_ids = {str(ancestor.id) for ancestor in thread_store.ancestors(newest)}
+    others = [
+        f"{status.account.acct}: {clean_content(status.content, bot_acct)}"
+        for status in statuses[:-1]
+        if str(status.id) not in ancestor_ids
+    ]
+    log(f"Answering {len(statuses)} mentions in one reply")
+    metrics.inc("mention_batches_total")
+    metrics.inc("mentions_coalesced_total", len(statuses) - 1)
+    return newest, [status.account.acct for status in statuses[:-1]], others
+
+def handle_mentions(notes, bot_acct):
+    """Generates and posts replies for a batch of mention notifications from one thread."""
+    for statuses in mention_batches(notes, bot_acct):
+        with mention_trace(statuses):
+            handle_batch(statuses, bot_acct)
+
+def handle_batch(statuses, bot_acct):
+    """Answers one or more mentions with a single reply to the newest of them."""
+    status = statuses[-1]
+    user_acct = status.account.acct
+    key = thread_key(status)
+    log(f"Processing mention from @{user_acct}")
+
+    # Gemini needs the image bytes; start downloading them while we fetch the thread
+    image_urls = [url for s in statuses for url in image_attachment_urls(s)]
+    images, budget = None, ByteBudget(IMAGE_MAX_TOTAL_BYTES)
+    if image_urls and "gemini" in PROVIDERS:
+        images = prefetch_images(image_urls, budget)
+
+    try:
+        # Extract conversation context
+        convo = build_conversation(status, bot_acct)
+
+        # Handle yaoi mode toggle
+        if len(statuses) == 1 and handle_yaoi_toggle(status, user_acct, key, convo.lower()):
+            return
+
+        # Generate reply with AI API
+        status, also_mention, others = batch_context(statuses, bot_acct)
+        log(f"Generating reply with {AI_PROVIDER.upper()}...")
+        reply = generate_reply(conversation_prompt(convo, others), image_urls=image_urls, images=images)
+
+        # Post reply if we got one
+        post_reply(status, user_acct, key, reply, also_mention=also_mention)
+    finally:
+        # Don't leave downloads running for a mention we are done with; running ones stop at their next chunk
+        budget.close()
+        for image in images or ():
+            image.cancel()
+
+def notification_key(note):
+    """Returns the ordering key for a notification."""
+    status = getattr(note, "status", None)
+    return thread_key(status) if status else note.id
+
+# --- Notification cursor ---
+def load_cursor():
+    try:
+        with open(CURSOR_FILE, "r") as f:
+            return json.load(f).get("last_id")
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def save_cursor(note_id):
+    """Persists the cursor; a cursor older than the saved one is ignored, so it never moves backwards."""
+    saved = load_cursor()
+    if saved is not None and notification_order(note_id) <= notification_order(saved):
+        return
+    # Write to a temp file first so a crash never leaves a truncated cursor behind
+    tmp_path = CURSOR_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"last_id": note_id}, f)
+    os.replace(tmp_path, CURSOR_FILE)
+
+# --- Mention intake ---
+last_id = None  # newest notification ID that has been fully handled
+
+def on_commit(note_id):
+    """Advances and persists the cursor once a mention and everything before it is handled."""
+    global last_id
+    if last_id is not None and notification_order(note_id) <= notification_order(last_id):
+        return
+    last_id = note_id
+    try:
+        save_cursor(note_id)
+    except OSError as e:
+        log(f"Failed to save notification cursor: {e}", level="error")
+
+def iter_mentions(since_id):
+    """Yields every mention newer than since_id, oldest first, across as many pages as needed."""
+    min_id = since_id
+    while True:
+        # min_id returns the page directly after min_id, so we walk forward through the backlog
+        page = mastodon.notifications(types=["mention"], min_id=min_id, limit=NOTIFICATION_PAGE_SIZE)
+        if not page:
+            return
+        # Pages come back newest first
+        yield from reversed(page)
+        if len(page) < NOTIFICATION_PAGE_SIZE:
+            return
+        min_id = page[0].id
+
+def poll_mentions(dispatcher, catch_up=False) -> int:
+    """Queues mentions received since the cursor. Returns how many were new.
+
+    With `catch_up`, the mentions are a backlog from while the bot was away:
+    they skip the per-account rate limit and are never shed.
+    """
+    # Mentions still in flight are skipped by the dispatcher; submit blocks while
+    # the worker pool is saturated, so a big backlog drains at the pool's pace
+    dropped, fetched = dispatcher.dropped_ids(), set()
+    queued = 0
+    for note in iter_mentions(last_id):
+        fetched.add(note.id)
+        if dispatcher.submit(note.id, notification_key(note), note, note.account.acct, catch_up):
+            queued += 1
+    # Dropped mentions are all newer than the cursor, so any this poll missed are gone (deleted)
+    dispatcher.forget_dropped(dropped - fetched)
+
+    if queued:
+        log(f"Found {queued} new mentions ({dispatcher.pending()} in progress)")
+    return queued
+
+class MentionStreamListener(StreamListener):
+    """Pushes mention notifications from the user stream into a dispatcher's `submit`.
+
+    `connected` is set every time the stream (re)connects, so the caller can
+    catch up on whatever was sent in the gap; the stream never replays it.
+    """
+
+    def __init__(self, submit):
+        super().__init__()
+        self.submit = submit
+        self.connected = threading.Event()
+
+    def handle_stream(self, response):
+        # Mastodon.py calls this for every new connection, including the
+        # immediate reconnects that is_receiving() is almost never False for
+        self.connected.set()
+        return super().handle_stream(response)
+
+    def on_notification(self, notification):
+        if notification.type == "mention":
+            log(f"Streamed mention {notification.id}")
+            self.submit(notification.id, notification_key(notification), notification, notification.account.acct)
+
+    def on_abort(self, err):
+        log(f"Stream disconnected: {err}", level="warning")
+
+def run_polling(dispatcher):
+    """Polls for mentions every POLL_INTERVAL seconds."""
+    failures = 0
+    while True:
+        try:
+            poll_mentions(dispatcher)
+            failures = 0
+            
+            # Wait before next poll
+            time.sleep(POLL_INTERVAL)
+        
+        except Exception as e:
+            failures += 1
+            delay = error_backoff(failures)
+            log(f"Error in main loop: {e} (retrying in {delay:.0f}s)", level="error")
+            time.sleep(delay)
+
+def run_streaming(dispatcher):
+    """Receives mentions from the streaming API, polling to cover any gaps."""
+    listener = MentionStreamListener(dispatcher.submit)
+    handle = None
+    last_poll = 0.0
+    failures = 0
+
+    while True:
+        try:
+            if handle is None or not handle.is_alive():
+                log("Connecting to streaming API...")
+                handle = mastodon.stream_user(
+                    listener,
+                    run_async=True,
+                    reconnect_async=True,
+                    reconnect_async_wait_sec=STREAM_RECONNECT_WAIT
+                )
+
+            if listener.connected.is_set():
+                # (Re)connected: catch up on anything sent while we were away
+                listener.connected.clear()
+                log("Stream connected, catching up on missed mentions")
+                poll_mentions(dispatcher, catch_up=True)
+                last_poll = time.monotonic()
+            elif (not handle.is_receiving() or dispatcher.dropped()) and time.monotonic() - last_poll >= POLL_INTERVAL:
+                # Stream is down, or mentions were shed while busy: poll for them
+                poll_mentions(dispatcher)
+                last_poll = time.monotonic()
+
+            failures = 0
+            time.sleep(1)
+
+        except Exception as e:
+            failures += 1
+            delay = error_backoff(failures)
+            log(f"Error in stream loop: {e} (retrying in {delay:.0f}s)", level="error")
+            listener.connected.set()  # the catch-up may not have finished
+            time.sleep(delay)
+
+# --- Async engine ---
+# Every mention, model call, download and tool call shares one event loop.
+# Mastodon.py only has a blocking API, so its calls (and the thread store and
+# media cache built on it) run on a bounded thread pool via asyncio.to_thread.
+async_openai_client = None
+
+async def get_image_bytes_async(url: str, budget: ByteBudget = None) -> tuple:
+    """get_image_bytes on the async HTTP client."""
+    with stage("image_download"):
+        async with asyncio.timeout(IMAGE_DOWNLOAD_TIMEOUT), async_http.stream("GET", url) as resp:
+            resp.raise_for_status()
+            mime_type = resp.headers.get("Content-Type", "image/jpeg").split(";")[0].strip()
+            chunks = []
+            async for chunk in resp.aiter_bytes(65536):
+                if budget is not None and not budget.take(len(chunk)):
+                    raise ValueError("image byte budget exceeded")
+                chunks.append(chunk)
+    return b"".join(chunks), mime_type
+
+def prefetch_images_async(image_urls: list) -> list:
+    """Starts downloading all images concurrently. Returns one task per URL."""
+    budget = ByteBudget(IMAGE_MAX_TOTAL_BYTES)
+    return [asyncio.create_task(get_image_bytes_async(url, budget)) for url in image_urls]
+
+async def execute_functions_async(calls: list) -> list:
+    """execute_functions for the async engine: all calls at once, results in order."""
+    async def run(fn_name, fn_args):
+        try:
+            with background(), tracing.span("tool", tool=fn_name):
+                return await asyncio.wait_for(tools.execute_async(fn_name, fn_args), tools.timeout(fn_name))
+        except Exception as e:
+            return tool_error(fn_name, e)
+
+    parallel, serial = split_parallel(calls)
+    results = [None] * len(calls)
+    parallel_results = await asyncio.gather(*(run(fn_name, fn_args) for _, fn_name, fn_args in parallel))
+    for (i, _, _), result in zip(parallel, parallel_results):
+        results[i] = result
+    for i, fn_name, fn_args in serial:
+        results[i] = await run(fn_name, fn_args)
+    return results
+
+async def openai_create_async(messages: list, tier: Tier):
+    """openai_create on the async OpenAI client."""
+    request = openai_request(messages, tier)
+    estimate = openai_request_tokens(request)
+    limiter = llm_limiters["openai"]
+    await limiter.acquire_async(estimate)
+    try:
+        with llm_round("openai", request["model"]):
+            response = await async_openai_client.chat.completions.create(**request)
+    except RateLimitError as e:
+        limiter.hold(retry_after(e))
+        raise
+    limiter.settle(estimate, record_openai_usage(response, request["model"]))
+    return response
+
+async def generate_reply_openai_async(prompt: str, image_urls: list[str] = None, tier: Tier = TIERS[0]) -> str:
+    """generate_reply_openai on the async OpenAI client."""
+    messages = openai_messages(prompt, image_urls)
+    response = await openai_create_async(messages, tier)
+    message = response.choices[0].message
+    if message.tool_calls:
+        return await handle_openai_function_calls_async(messages, message, tier)
+    return message.content.strip() if message.content else ""
+
+async def handle_openai_function_calls_async(messages: list, assistant_message, tier: Tier):
+    """handle_openai_function_calls on the async OpenAI client."""
+    max_calls = tier.max_tool_rounds
+    calls_made = 0
+    current_messages = messages.copy()
+    current_messages.append(assistant_message)
+
+    while calls_made < max_calls and assistant_message.tool_calls:
+        calls_made += 1
+        calls = openai_tool_calls(assistant_message)
+        results = await execute_functions_async(calls)
+        current_messages.extend(openai_tool_results(assistant_message, results))
+
+        response = await openai_create_async(current_messages, tier)
+        assistant_message = response.choices[0].message
+        current_messages.append(assistant_message)
+
+    return openai_final_text(assistant_message, calls_made, max_calls)
+
+async def gemini_generate_async(contents: list, config, model: str) -> tuple:
+    """gemini_generate on the genai aio client."""
+    estimate = gemini_request_tokens(contents)
+    limiter = llm_limiters["gemini"]
+    await limiter.acquire_async(estimate)
+    try:
+        with llm_round("gemini", model):
+            response = await genai_client.aio.models.generate_content(model=model, contents=contents, config=config)
+    except genai_errors.ClientError as e:
+        if e.code == 429:
+            limiter.hold(retry_after(e))
+        if not is_stale_cache_error(config, e):
+            raise
+        cache = gemini_context_caches[model]
+        cache.invalidate(config.cached_content)
+        config = cache.inline_config(config.max_output_tokens)
+        with llm_round("gemini", model):
+            response = await genai_client.aio.models.generate_content(model=model, contents=contents, config=config)
+    limiter.settle(estimate, record_gemini_usage(response, model))
+    return response, config
+
+async def generate_reply_gemini_async(prompt: str, image_urls: list[str] = None, images: list = None,
+                                      tier: Tier = TIERS[0]) -> str:
+    """generate_reply_gemini on the genai aio client. `images` are tasks from prefetch_images_async."""
+    contents = []
+    if image_urls:
+        if images is None:
+            images = prefetch_images_async(image_urls)
+        for img_url, image in zip(image_urls, images):
+            try:
+                contents.append(gemini_image_part(await asyncio.wait_for(image, IMAGE_DOWNLOAD_TIMEOUT)))
+            except Exception as e:
+                log(f"Failed to process image {img_url}: {e}", level="error")
+                continue
+
+    contents.append(types.Content(role="user", parts=[types.Part(text=prompt)]))
+    # Creating or renewing the context cache is a blocking call, but only once an hour
+    config = await asyncio.to_thread(gemini_config, tier)
+
+    response, config = await gemini_generate_async(contents, config, tier.gemini_model)
+    model_content = response.candidates[0].content
+    if gemini_function_calls(model_content):
+        return await handle_gemini_function_call_async(model_content, contents, config, tier)
+    return gemini_text(model_content)
+
+async def handle_gemini_function_call_async(model_content, contents, config, tier: Tier):
+    """handle_gemini_function_call on the genai aio client."""
+    max_calls = tier.max_tool_rounds
+    calls_made = 0
+    current_contents = contents.copy()
+
+    while calls_made < max_calls:
+        calls_made += 1
+        calls = gemini_tool_calls(model_content)
+        results = await execute_functions_async(calls)
+        current_contents.append(model_content)
+        current_contents.append(gemini_tool_results(calls, results))
+
+        final_response, config = await gemini_generate_async(current_contents, config, tier.gemini_model)
+        model_content = final_response.candidates[0].content
+        if not gemini_function_calls(model_content):
+            return gemini_text(model_content)
+
+    return GEMINI_LIMIT_PREFIX + gemini_text(model_content)
+
+async def generate_reply_async(prompt: str, image_urls: list[str] = None, images: list = None) -> str:
+    """generate_reply for the async engine; the losing provider of a hedge is cancelled."""
+    tier = tier_policy.current()
+    started = time.monotonic()
+    with stage("generate", tier=tier.name):
+        reply = await provider_router.call_async({
+            "gemini": lambda: generate_reply_gemini_async(prompt, image_urls, images, tier),
+            "openai": lambda: generate_reply_openai_async(prompt, image_urls, tier),
+        })
+    tier_policy.record(time.monotonic() - started)
+    return reply
+
+async def handle_mentions_async(notes, bot_acct):
+    """handle_mentions for the async engine."""
+    for statuses in await asyncio.to_thread(mention_batches, notes, bot_acct):
+        with mention_trace(statuses):
+            await handle_batch_async(statuses, bot_acct)
+
+async def handle_batch_async(statuses, bot_acct):
+    """handle_batch for the async engine."""
+    status = statuses[-1]
+    user_acct = status.account.acct
+    key = thread_key(status)
+    log(f"Processing mention from @{user_acct}")
+
+    image_urls = [url for s in statuses for url in image_attachment_urls(s)]
+    images = []
+    if image_urls and "gemini" in PROVIDERS:
+        images = prefetch_images_async(image_urls)
+
+    try:
+        convo = await asyncio.to_thread(build_conversation, status, bot_acct)
+        if len(statuses) == 1 and await asyncio.to_thread(handle_yaoi_toggle, status, user_acct, key, convo.lower()):
+            return
+
+        status, also_mention, others = await asyncio.to_thread(batch_context, statuses, bot_acct)
+        log(f"Generating reply with {AI_PROVIDER.upper()}...")
+        reply = await generate_reply_async(conversation_prompt(convo, others), image_urls=image_urls, images=images or None)
+        await asyncio.to_thread(post_reply, status, user_acct, key, reply, also_mention)
+    finally:
+        # Don't leave downloads running for a mention we are done with
+        for image in images:
+            image.cancel()
+
+async def poll_mentions_async(dispatcher, catch_up=False) -> int:
+    """poll_mentions for the async engine."""
+    dropped = dispatcher.dropped_ids()
+    notes = await asyncio.to_thread(lambda: list(iter_mentions(last_id)))
+    queued = 0
+    for note in notes:
+        if await dispatcher.submit(note.id, notification_key(note), note, note.account.acct, catch_up):
+            queued += 1
+    dispatcher.forget_dropped(dropped - {note.id for note in notes})
+
+    if queued:
+        log(f"Found {queued} new mentions ({dispatcher.pending()} in progress)")
+    return queued
+
+async def run_polling_async(dispatcher):
+    """run_polling for the async engine."""
+    failures = 0
+    while True:
+        try:
+            await poll_mentions_async(dispatcher)
+            failures = 0
+            await asyncio.sleep(POLL_INTERVAL)
+        except Exception as e:
+            failures += 1
+            delay = error_backoff(failures)
+            log(f"Error in main loop: {e} (retrying in {delay:.0f}s)", level="error")
+            await asyncio.sleep(delay)
+
+async def run_streaming_async(dispatcher):
+    """run_streaming for the async engine; the stream itself runs on Mastodon.py's thread."""
+    listener = MentionStreamListener(dispatcher.submit_threadsafe)
+    handle = None
+    last_poll = 0.0
+    failures = 0
+
+    while True:
+        try:
+            if handle is None or not handle.is_alive():
+                log("Connecting to streaming API...")
+                handle = await asyncio.to_thread(
+                    mastodon.stream_user,
+                    listener,
+                    run_async=True,
+                    reconnect_async=True,
+                    reconnect_async_wait_sec=STREAM_RECONNECT_WAIT
+                )
+
+            if listener.connected.is_set():
+                listener.connected.clear()
+                log("Stream connected, catching up on missed mentions")
+                await poll_mentions_async(dispatcher, catch_up=True)
+                last_poll = time.monotonic()
+            elif (not handle.is_receiving() or dispatcher.dropped()) and time.monotonic() - last_poll >= POLL_INTERVAL:
+                await poll_mentions_async(dispatcher)
+                last_poll = time.monotonic()
+
+            failures = 0
+            await asyncio.sleep(1)
+
+        except Exception as e:
+            failures += 1
+            delay = error_backoff(failures)
+            log(f"Error in stream loop: {e} (retrying in {delay:.0f}s)", level="error")
+            listener.connected.set()
+            await asyncio.sleep(delay)
+
+async def run_async_engine(intake, bot_acct):
+    """Runs the bot on the async engine until interrupted."""
+    global async_http, async_openai_client
+
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=BLOCKING_POOL_SIZE, thread_name_prefix="blocking")
+    )
+    async_http = http_client.async_client()
+    if openai_client is not None:
+        async_openai_client = AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            base_url=OPENAI_BASE_URL if OPENAI_BASE_URL else None,
+            http_client=DefaultAsyncHttpxClient(limits=http_limits)
+        )
+
+    dispatcher = AsyncMentionDispatcher(
+        lambda notes: handle_mentions_async(notes, bot_acct),
+        concurrency=ASYNC_CONCURRENCY,
+        max_pending=WORKER_QUEUE_DEPTH,
+        on_commit=on_commit,
+        max_batch=MENTION_BATCH_MAX,
+        coalesce_window=MENTION_BATCH_WINDOW,
+        user_rate=USER_MENTIONS_PER_MINUTE,
+        user_burst=USER_MENTION_BURST
+    )
+    tier_policy.queue_depth = dispatcher.waiting
+    try:
+        log("Draining mention backlog...")
+        backlog = await poll_mentions_async(dispatcher, catch_up=True)
+        log(f"Queued {backlog} backlog mentions")
+
+        if intake == "stream":
+            await run_streaming_async(dispatcher)
+        else:
+            await run_polling_async(dispatcher)
+    finally:
+        await async_http.aclose()
+        if async_openai_client is not None:
+            await async_openai_client.close()
 
 def main():
+    global last_id
+
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Mastodon AI Bot')
     parser.add_argument('--yaoi-of-the-day', action='store_true', help='Post a single yaoi-of-the-day post')
+    parser.add_argument('--intake', choices=["stream", "poll"], default=INTAKE_MODE, help='How to receive mentions')
+    parser.add_argument('--engine', choices=["async", "sync"], default=ENGINE, help='Run on asyncio or on worker threads')
+    parser.add_argument('--profile', type=int, default=0, metavar='N', help=f'cProfile the next N mentions into {PROFILE_DIR}')
     args = parser.parse_args()
     
     # Initialize Mastodon client
     me = mastodon.account_verify_credentials()
     bot_acct = me.acct
-    print(f"Bot account: @{bot_acct}")
+    log(f"Bot account: @{bot_acct}")
     
     # If yaoi-of-the-day mode is enabled, post once and exit
     if args.yaoi_of_the_day:
@@ -685,116 +1752,61 @@ def main():
         return
     
     # Normal bot operation continues here...
-    print("Starting Mastodon AI bot in normal mode...")
+    log("Starting Mastodon AI bot in normal mode...")
+
+    if METRICS_PORT:
+        try:
+            metrics.serve(METRICS_PORT)
+            log(f"Serving metrics at http://127.0.0.1:{METRICS_PORT}/metrics")
+        except OSError as e:
+            log(f"Could not serve metrics on port {METRICS_PORT}: {e}", level="error")
+
+    # Profile on demand: `kill -USR1 <pid>` profiles the next PROFILE_MENTIONS mentions
+    if args.profile:
+        profiler.arm(args.profile)
+        log(f"Profiling the next {args.profile} mentions into {PROFILE_DIR}")
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.arm(PROFILE_MENTIONS))
     
-    # Get the most recent notification to establish baseline
-    initial = mastodon.notifications(types=["mention"], limit=1)
-    last_id = initial[0].id if initial else None
+    # Resume from the saved cursor, or establish a baseline on first run
+    last_id = load_cursor()
+    if last_id is None:
+        initial = mastodon.notifications(types=["mention"], limit=1)
+        last_id = initial[0].id if initial else None
+        if last_id is not None:
+            save_cursor(last_id)
     
-    print(f"Starting from notification ID: {last_id}")
-    print(f"Polling interval: {POLL_INTERVAL} seconds")
+    log(f"Starting from notification ID: {last_id}")
+    log(f"Intake mode: {args.intake}, polling interval: {POLL_INTERVAL} seconds")
+
+    if args.engine == "async":
+        log(f"Async engine: {ASYNC_CONCURRENCY} mentions at once, queue depth {WORKER_QUEUE_DEPTH}")
+        asyncio.run(run_async_engine(args.intake, bot_acct))
+        return
+
+    log(f"Worker pool: {WORKER_POOL_SIZE} workers, queue depth {WORKER_QUEUE_DEPTH}")
+
+    dispatcher = MentionDispatcher(
+        lambda notes: handle_mentions(notes, bot_acct),
+        workers=WORKER_POOL_SIZE,
+        max_pending=WORKER_QUEUE_DEPTH,
+        on_commit=on_commit,
+        max_batch=MENTION_BATCH_MAX,
+        coalesce_window=MENTION_BATCH_WINDOW,
+        user_rate=USER_MENTIONS_PER_MINUTE,
+        user_burst=USER_MENTION_BURST
+    )
+    tier_policy.queue_depth = dispatcher.waiting
+
+    # Work through everything that arrived while we were down before going live
+    log("Draining mention backlog...")
+    backlog = poll_mentions(dispatcher, catch_up=True)
+    log(f"Queued {backlog} backlog mentions")
     
-    while True:
-        try:
-            # Fetch new mentions
-            mentions = mastodon.notifications(types=["mention"], since_id=last_id)
-            
-            if mentions:
-                print(f"Found {len(mentions)} new mentions")
-            
-            for note in reversed(mentions):
-                # make absolutely sure we're dealing with a mention
-                if note.type != "mention":
-                    continue
-                # safely get status (won't blow up if it's missing)
-                status = getattr(note, "status", None)
-                if not status or status.account.acct.lower() == bot_acct.lower():
-                    continue
-
-                user_acct = status.account.acct
-                print(f"Processing mention from @{user_acct}")
-                
-                # Update last seen ID
-                last_id = max(last_id or note.id, note.id)
-                
-                # Extract conversation context
-                convo = build_conversation(status, bot_acct)
-                content_text = convo.lower()
-
-                # Handle yaoi mode toggle
-                if "enable yaoi mode" in content_text:
-                    yaoi_mode_users.add(user_acct)
-                    save_yaoi_mode_users(yaoi_mode_users)
-                    media = upload_image("./image.png")
-                    mastodon.status_post(
-                        status=f"@{user_acct} Yaoi mode enabled just for you. 🌸",
-                        media_ids=[m.id for m in media],
-                        in_reply_to_id=status.id,
-                        visibility=status.visibility
-                    )
-                    print(f"Enabled yaoi mode for @{user_acct}")
-                    continue
-
-                if "disable yaoi mode" in content_text:
-                    yaoi_mode_users.discard(user_acct)
-                    save_yaoi_mode_users(yaoi_mode_users)
-                    mastodon.status_post(
-                        status=f"@{user_acct} Yaoi mode disabled for you. 💔",
-                        in_reply_to_id=status.id,
-                        visibility=status.visibility
-                    )
-                    print(f"Disabled yaoi mode for @{user_acct}")
-                    continue
-
-                # Check for URLs in the content for potential function calls
-                urls = extract_urls(content_text)
-                if urls:
-                    print(f"Found URLs in content: {urls}")
-                
-                # Process image attachments
-                image_urls = []
-                for media in status.media_attachments or []:
-                    url = getattr(media, 'url', None) or media.get('preview_url')
-                    if url:
-                        image_urls.append(url)
-                
-                if image_urls:
-                    print(f"Found {len(image_urls)} attached images")
-
-                # Generate prompt with conversation context
-                prompt = f"CONVERSATION:\n{convo}\nBot:"
-                
-                # Generate reply with AI API
-                print(f"Generating reply with {AI_PROVIDER.upper()}...")
-                reply = generate_reply(prompt, image_urls=image_urls)
-
-                # Post reply if we got one
-                if reply:
-                    # Determine reply visibility: convert any public to unlisted
-                    reply_visibility = "unlisted" if status.visibility == "public" else status.visibility
-                    media_ids = []
-                    if user_acct in yaoi_mode_users:
-                        print(f"Adding yaoi mode image for @{user_acct}")
-                        media = upload_image("./image.png")
-                        media_ids = [m.id for m in media]
-                    
-                    print(f"Posting reply (visibility={reply_visibility}): {reply[:50]}...")
-                    mastodon.status_post(
-                        status=f"@{user_acct} {reply}",
-                        in_reply_to_id=status.id,
-                        media_ids=media_ids,
-                        visibility=reply_visibility
-                    )
-                    print("Reply posted successfully")
-                else:
-                    print("No reply generated")
-            
-            # Wait before next poll
-            time.sleep(POLL_INTERVAL)
-        
-        except Exception as e:
-            print(f"Error in main loop: {e}")
-            time.sleep(60)  # Wait a minute before retrying after an error
+    if args.intake == "stream":
+        run_streaming(dispatcher)
+    else:
+        run_polling(dispatcher)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,152 @@
+"""
+Media Cache
+Remembers uploaded media IDs by file content so unchanged images are not
+uploaded again for every reply.
+"""
+
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import metrics
+from tracing import log
+
+SPARE_TTL = 6 * 3600  # seconds a pre-uploaded spare is used for; Mastodon deletes unattached media after about a day
+
+
+class MediaCache:
+    """Maps image files to already-uploaded media, keyed by content hash.
+
+    Files are re-hashed only when their mtime, size or inode change, so a swap
+    of the file on disk invalidates the entry automatically.
+
+    In "reuse" mode a media ID is handed out for every post while the file is
+    unchanged. Vanilla Mastodon refuses to attach a media ID to a second status,
+    so "prefetch" mode hands each ID out once and immediately uploads a spare in
+    the background, keeping the upload off the reply path. Spares older than
+    `spare_ttl` seconds are not handed out, since the server may have deleted
+    them by then.
+    """
+
+    def __init__(self, upload, mode="prefetch", max_entries=64, spare_ttl=SPARE_TTL):
+        if mode not in ("reuse", "prefetch"):
+            raise ValueError(f"Unknown media cache mode: {mode}")
+        self._upload = upload
+        self._mode = mode
+        self._max_entries = max_entries
+        self._spare_ttl = spare_ttl
+        self._lock = threading.Lock()
+        self._digests = OrderedDict()  # path -> (signature, digest), least recently used first
+        self._media = OrderedDict()  # digest -> (media list, time it was uploaded)
+        self._refilling = set()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path: str, upcoming: str = None, prefetch=True) -> list:
+        """Returns media for `path`, uploading it only if it is not cached.
+
+        In prefetch mode the spare is uploaded for `upcoming` if given, i.e.
+        the file the next call is expected to ask for. Pass `prefetch=False`
+        when no further call will come, e.g. from a one-shot run.
+        """
+        try:
+            digest = self._digest(path)
+        except OSError as e:
+            log(f"Failed to read image {path}: {e}", level="error")
+            return []
+        with self._lock:
+            media, uploaded_at = self._media.get(digest, (None, 0))
+            if media is not None and self._mode == "prefetch" and time.time() - uploaded_at > self._spare_ttl:
+                del self._media[digest]
+                media = None
+            if media is not None:
+                self.hits += 1
+                if self._mode == "prefetch":
+                    del self._media[digest]
+                else:
+                    self._media.move_to_end(digest)
+            else:
+                self.misses += 1
+        metrics.inc("media_cache_requests_total", result="hit" if media is not None else "miss")
+        metrics.set_gauge("media_cache_hit_rate", self.hit_rate())
+        log(f"Media cache {'hit' if media is not None else 'miss'} for {path} (hit rate {self.hit_rate():.0%})")
+
+        if media is None:
+            media = self._upload(path)
+            if self._mode == "reuse":
+                self._store(path, digest, media)
+        if self._mode == "prefetch" and prefetch:
+            self._prefetch(upcoming or path, digest if not upcoming else None)
+        return media
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _signature(self, path):
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def _digest(self, path):
+        try:
+            signature = self._signature(path)
+        except OSError:
+            # The pool rotated this file out; forget it
+            with self._lock:
+                self._digests.pop(path, None)
+            raise
+        with self._lock:
+            cached = self._digests.get(path)
+            if cached:
+                self._digests.move_to_end(path)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        with self._lock:
+            self._digests[path] = (signature, digest)
+            self._digests.move_to_end(path)
+            while len(self._digests) > self._max_entries:
+                self._digests.popitem(last=False)
+        return digest
+
+    def _store(self, path, digest, media):
+        # Don't cache failed uploads or an upload of a file that changed underneath us
+        if not media or self._digest(path) != digest:
+            return
+        with self._lock:
+            self._media[digest] = (media, time.time())
+            self._media.move_to_end(digest)
+            while len(self._media) > self._max_entries:
+                self._media.popitem(last=False)
+
+    def _prefetch(self, path, digest=None):
+        if digest is None:
+            try:
+                digest = self._digest(path)
+            except OSError as e:
+                log(f"Failed to read image {path}: {e}", level="error")
+                return
+        self._refill(path, digest)
+
+    def _refill(self, path, digest):
+        with self._lock:
+            spare = self._media.get(digest)
+            fresh = spare is not None and time.time() - spare[1] <= self._spare_ttl
+            if fresh or digest in self._refilling:
+                return
+            self._refilling.add(digest)
+
+        def upload_spare():
+            try:
+                self._store(path, digest, self._upload(path))
+            except Exception as e:
+                log(f"Failed to pre-upload {path}: {e}", level="error")
+            finally:
+                with self._lock:
+                    self._refilling.discard(digest)
+
+        threading.Thread(target=upload_spare, daemon=True).start()
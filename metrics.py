@@ -0,0 +1,137 @@
+"""
+Metrics
+Thread-safe in-process counters, gauges and histograms shared by the bot's
+subsystems, and a small HTTP endpoint that serves them in the Prometheus
+text format.
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds (seconds) of histogram buckets; the last bucket takes everything above
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_lock = threading.Lock()
+_counters = {}  # (name, labels) -> value
+_gauges = {}
+_histograms = {}  # (name, labels) -> {"buckets": counts per bound plus overflow, "sum", "count"}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Adds `value` to a counter."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """Sets a gauge to `value`."""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    """Records `value` in a histogram."""
+    key = _key(name, labels)
+    index = next((i for i, bound in enumerate(BUCKETS) if value <= bound), len(BUCKETS))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": [0] * (len(BUCKETS) + 1), "sum": 0.0, "count": 0}
+        histogram["buckets"][index] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observes how long the block took, in seconds, in a histogram (also when it raises)."""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - started, **labels)
+
+
+def get(name, **labels):
+    """Returns the current value of a counter or gauge (0 if never set)."""
+    key = _key(name, labels)
+    with _lock:
+        return _counters.get(key, _gauges.get(key, 0))
+
+
+def snapshot() -> dict:
+    """Returns a copy of every counter, gauge and histogram, keyed by (name, labels)."""
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "histograms": {key: dict(h, buckets=list(h["buckets"])) for key, h in _histograms.items()},
+        }
+
+
+def render() -> str:
+    """Every metric in the Prometheus text exposition format."""
+    data = snapshot()
+    lines = []
+    for kind, series in (("counter", data["counters"]), ("gauge", data["gauges"])):
+        for name, group in _by_name(series):
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(f"{name}{_labels(labels)} {value}" for labels, value in group)
+    for name, group in _by_name(data["histograms"]):
+        lines.append(f"# TYPE {name} histogram")
+        for labels, histogram in group:
+            cumulative = 0
+            for bound, count in zip((*BUCKETS, "+Inf"), histogram["buckets"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def serve(port, host="127.0.0.1") -> ThreadingHTTPServer:
+    """Serves `render()` at http://host:port/metrics on a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes every few seconds would drown out the bot's own output
+
+
+def _by_name(series):
+    """Groups {(name, labels): value} into (name, [(labels, value)]) sorted by name."""
+    groups = {}
+    for (name, labels), value in sorted(series.items(), key=lambda item: (item[0][0], item[0][1])):
+        groups.setdefault(name, []).append((labels, value))
+    return groups.items()
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,76 @@
+"""
+Page Cache
+On-disk cache of fetched web pages, revalidated with conditional GETs.
+"""
+
+import os
+import json
+import hashlib
+import threading
+
+from tracing import log
+
+
+class PageCache:
+    """Stores extracted page text with its ETag/Last-Modified validators.
+
+    One JSON file per URL, written atomically. The oldest files are pruned
+    once there are more than `max_entries`.
+    """
+
+    def __init__(self, directory, max_entries=500):
+        self._directory = directory
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def _path(self, url):
+        return os.path.join(self._directory, hashlib.sha256(url.encode()).hexdigest() + ".json")
+
+    def get(self, url):
+        """Returns the cached entry for `url`, or None."""
+        try:
+            with open(self._path(url), "r") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return entry if entry.get("url") == url else None
+
+    def touch(self, url):
+        """Marks an entry as recently used so pruning keeps it."""
+        try:
+            os.utime(self._path(url))
+        except OSError:
+            pass
+
+    def validators(self, entry) -> dict:
+        """Conditional request headers for a cached entry."""
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def put(self, url, result, etag=None, last_modified=None):
+        """Caches `result` if the server gave us something to revalidate it with."""
+        if not etag and not last_modified:
+            return
+        os.makedirs(self._directory, exist_ok=True)
+        path = self._path(url)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"url": url, "etag": etag, "last_modified": last_modified, "result": result}, f)
+        os.replace(tmp_path, path)
+        self._prune()
+
+    def _prune(self):
+        with self._lock:
+            try:
+                names = [n for n in os.listdir(self._directory) if n.endswith(".json")]
+                if len(names) <= self._max_entries:
+                    return
+                paths = sorted((os.path.join(self._directory, n) for n in names), key=os.path.getmtime)
+                for path in paths[:len(paths) - self._max_entries]:
+                    os.remove(path)
+            except OSError as e:
+                log(f"Failed to prune page cache: {e}", level="error")
@@ -0,0 +1,98 @@
+"""
+Post Index
+Local SQLite index of Danbooru post metadata, so picking the next yaoi image
+is a local lookup instead of an API call.
+"""
+
+import time
+import random
+import sqlite3
+
+# Columns kept per post; named like the Danbooru API fields so rows can be used as posts
+COLUMNS = ("id", "md5", "file_url", "large_file_url", "file_ext", "file_size", "image_width", "image_height")
+
+
+class PostIndex:
+    """Danbooru posts we can pick from, plus when each one was last used.
+
+    Posts are de-duplicated by md5, so a re-upload of the same file under a
+    new post ID is stored once. If `extensions` is given, only posts with one
+    of those `file_ext`s are kept. `pick()` prefers posts that were never used
+    or not used within `reuse_window` seconds.
+    """
+
+    def __init__(self, path, reuse_window=86400, extensions=None):
+        self._reuse_window = reuse_window
+        self._extensions = tuple(extensions) if extensions else None
+        self._conn = sqlite3.connect(path)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS posts ("
+                " id INTEGER PRIMARY KEY, md5 TEXT UNIQUE, file_url TEXT NOT NULL, large_file_url TEXT,"
+                " file_ext TEXT, file_size INTEGER, image_width INTEGER, image_height INTEGER,"
+                " last_used REAL NOT NULL DEFAULT 0)"
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            if self._extensions:
+                # Indexes written before the filter may still hold posts it rejects
+                self._conn.execute(
+                    f"DELETE FROM posts WHERE coalesce(file_ext, '') NOT IN ({', '.join('?' * len(self._extensions))})",
+                    self._extensions,
+                )
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+
+    def add(self, posts) -> int:
+        """Adds API posts that have a file URL (and an accepted extension). Returns how many were new."""
+        rows = [
+            tuple(post.get(column) for column in COLUMNS)
+            for post in posts
+            if post.get("file_url") and post.get("md5")
+            and (self._extensions is None or post.get("file_ext") in self._extensions)
+        ]
+        with self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                f"INSERT OR IGNORE INTO posts ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                rows,
+            )
+            return self._conn.total_changes - before
+
+    def remove(self, post_id):
+        """Drops a post whose file can no longer be downloaded."""
+        with self._conn:
+            self._conn.execute("DELETE FROM posts WHERE id = ?", (post_id,))
+
+    def id_range(self):
+        """Returns (oldest, newest) indexed post IDs, or (None, None) if empty."""
+        return tuple(self._conn.execute("SELECT MIN(id), MAX(id) FROM posts").fetchone())
+
+    def pick(self, exclude=()):
+        """Returns a random post as a dict, weighted away from recently used ones, or None."""
+        now = time.time()
+        exclude = set(exclude)
+        candidates = [
+            (post_id, last_used)
+            for post_id, last_used in self._conn.execute("SELECT id, last_used FROM posts")
+            if post_id not in exclude
+        ]
+        if not candidates:
+            return None
+        # Never used or outside the window: weight 1; used just now: close to 0 but still possible
+        weights = [max(0.01, min(1.0, (now - last_used) / self._reuse_window)) for _, last_used in candidates]
+        post_id = random.choices([post_id for post_id, _ in candidates], weights)[0]
+        return dict(self._conn.execute("SELECT * FROM posts WHERE id = ?", (post_id,)).fetchone())
+
+    def mark_used(self, post_id):
+        with self._conn:
+            self._conn.execute("UPDATE posts SET last_used = ? WHERE id = ?", (time.time(), post_id))
+
+    def get_meta(self, key, default=None):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
@@ -0,0 +1,71 @@
+"""
+Profiling
+On-demand cProfile dumps for the next few mentions, switched on with the
+--profile flag or by sending the bot SIGUSR1 while it runs. Each profiled
+mention gets its own .prof file, named after its trace ID, that can be
+opened with pstats or snakeviz.
+"""
+
+import os
+import time
+import cProfile
+import threading
+from contextlib import contextmanager
+
+import tracing
+
+
+class MentionProfiler:
+    """Profiles the next `arm(n)` mentions, one at a time, into `directory`.
+
+    cProfile sees only the thread it runs on: on the sync engine that is
+    the mention's worker (tool calls on the tool pool aren't included), on
+    the async engine it is the event loop, so anything else the loop runs
+    meanwhile shows up too. Mentions that start while another one is being
+    profiled are skipped and don't use up the count.
+    """
+
+    def __init__(self, directory="./profiles"):
+        self.directory = directory
+        self._remaining = 0
+        self._lock = threading.Lock()
+        self._active = False
+
+    def arm(self, count):
+        """Profiles the next `count` mentions. Safe to call from a signal handler."""
+        self._remaining = count  # a plain store, so no lock the interrupted thread might hold
+
+    @contextmanager
+    def profile(self, label):
+        """Profiles the block if armed and no other profile is running."""
+        with self._lock:
+            start = self._remaining > 0 and not self._active
+            if start:
+                self._remaining -= 1
+                self._active = True
+        if not start:
+            yield
+            return
+        profiler = cProfile.Profile()
+        started = time.monotonic()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            try:
+                self._dump(profiler, label, time.monotonic() - started)
+            finally:
+                with self._lock:
+                    self._active = False
+
+    def _dump(self, profiler, label, seconds):
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{tracing.current_trace() or label}.prof"
+        path = os.path.join(self.directory, name)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            profiler.dump_stats(path)
+        except OSError as e:
+            tracing.log(f"Failed to save profile for {label}: {e}", level="error")
+            return
+        tracing.log(f"Profiled {label} ({seconds:.2f}s), saved to {path}", profile=path, remaining=self._remaining)
@@ -0,0 +1,100 @@
+"""
+Prompt Builder
+Fits a thread into a token budget: the root post and the latest turns are
+kept verbatim, older turns in between are replaced by short summaries.
+"""
+
+import re
+
+from cache import TTLCache
+
+SUMMARY_CHARS = 160  # longest summary of a single turn
+SUMMARY_TTL = 86400  # summaries only depend on the status, so keep them around
+_SENTENCE_END = re.compile(r"(?<=[.!?。！？])\s")
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count: about 4 characters per token for English-ish text."""
+    return (len(text) + 3) // 4
+
+
+def summarize(text: str, limit: int = SUMMARY_CHARS) -> str:
+    """Extractive summary: the first sentence (or line), cut to `limit` characters."""
+    first = _SENTENCE_END.split(text.strip().split("\n", 1)[0], 1)[0]
+    if len(first) > limit:
+        first = first[:limit - 1].rstrip() + "…"
+    elif len(first) < len(text.strip()):
+        first += " …"
+    return first
+
+
+class PromptBuilder:
+    """Builds the CONVERSATION block of a prompt within `budget` estimated tokens.
+
+    Turns are (key, author, text), where the key identifies one version of a
+    status (its id, plus the edit time if it was edited). The root and the
+    last `keep_recent` turns are always included; middle turns are summarized
+    oldest first and then dropped until the thread fits. Summaries are cached
+    by key, so each one is computed once per thread instead of on every reply.
+    """
+
+    def __init__(self, budget=3000, keep_recent=6, cache_size=4096):
+        self.budget = budget
+        self.keep_recent = keep_recent
+        self._summaries = TTLCache(maxsize=cache_size)
+
+    def summary(self, key, text: str) -> str:
+        """Returns the cached summary for `key`, summarizing `text` on a miss."""
+        cached = self._summaries.get(key)
+        if cached is None:
+            cached = summarize(text)
+            self._summaries.set(key, cached, SUMMARY_TTL)
+        return cached
+
+    def build(self, turns: list) -> tuple:
+        """Returns (conversation text, turns summarized, turns dropped)."""
+        lines = [f"{author}: {text}" for _, author, text in turns]
+        costs = [estimate_tokens(line) + 1 for line in lines]
+        total = sum(costs)
+        summarized = 0
+        if total <= self.budget:
+            return "\n".join(lines), 0, 0
+
+        # Root is turns[0]; everything between it and the recent turns may be compressed
+        middle = range(1, max(1, len(turns) - self.keep_recent))
+        for i in middle:
+            if total <= self.budget:
+                break
+            key, author, text = turns[i]
+            line = f"{author}: {self.summary(key, text)}"
+            total += estimate_tokens(line) + 1 - costs[i]
+            lines[i], costs[i] = line, estimate_tokens(line) + 1
+            summarized += 1
+
+        dropped = []
+        for i in middle:
+            if total <= self.budget:
+                break
+            total -= costs[i]
+            dropped.append(i)
+        if dropped:
+            summarized -= len(dropped)  # every dropped turn had been summarized first
+            marker = f"[{len(dropped)} earlier posts skipped]"
+            lines[dropped[0]] = marker
+            for i in dropped[1:]:
+                lines[i] = None
+            total += estimate_tokens(marker) + 1
+
+        # Still too long: shorten the root and older recent turns, but never the newest post
+        shortenable = [0] if len(turns) > 1 else []
+        shortenable += range(max(1, len(turns) - self.keep_recent), len(turns) - 1)
+        for i in shortenable:
+            if total <= self.budget:
+                break
+            key, author, text = turns[i]
+            line = f"{author}: {self.summary(key, text)}"
+            total += estimate_tokens(line) + 1 - costs[i]
+            lines[i] = line
+            summarized += 1
+
+        return "\n".join(line for line in lines if line is not None), summarized, len(dropped)
@@ -0,0 +1,113 @@
+"""
+Prompt Cache
+Keeps the static part of every Gemini request (system instruction and tool
+declarations) in an explicit context cache, so it is uploaded once and
+referenced by name instead of being resent with every call.
+"""
+
+import time
+import threading
+
+from google.genai import types
+
+from tracing import log
+
+RENEW_MARGIN = 300  # seconds before expiry at which the cache TTL is extended
+
+
+class GeminiContextCache:
+    """Creates, renews and falls back from a Gemini cached content.
+
+    `config()` returns a GenerateContentConfig that points at the cache, or
+    one with the system instruction and tools inline if caching is disabled
+    or the cache could not be created (e.g. the prefix is below the model's
+    minimum cacheable size). Creation is retried after `retry_after` seconds.
+    Configs are built once per cache name and output limit and then reused.
+    """
+
+    def __init__(self, client, model, system_instruction, tools, ttl=3600, retry_after=3600, enabled=True):
+        self._client = client
+        self._model = model
+        self._system_instruction = system_instruction
+        self._tools = tools
+        self._ttl = ttl
+        self._retry_after = retry_after
+        self._enabled = enabled
+        self._lock = threading.Lock()
+        self._name = None
+        self._expires = 0.0
+        self._retry_at = 0.0
+        self._configs = {}  # (cache name or None, max_output_tokens) -> GenerateContentConfig
+
+    def config(self, max_output_tokens=None):
+        """Config for a request: the cache handle if we have one, else everything inline."""
+        name = self._ensure() if self._enabled else None
+        return self._config(name, max_output_tokens)
+
+    def inline_config(self, max_output_tokens=None):
+        """Config with the system instruction and tools inline, for when the cache went away."""
+        return self._config(None, max_output_tokens)
+
+    def _config(self, name, max_output_tokens):
+        key = (name, max_output_tokens)
+        with self._lock:
+            config = self._configs.get(key)
+            if config is None:
+                if name:
+                    config = types.GenerateContentConfig(cached_content=name, max_output_tokens=max_output_tokens)
+                else:
+                    config = types.GenerateContentConfig(
+                        system_instruction=self._system_instruction,
+                        tools=self._tools,
+                        max_output_tokens=max_output_tokens
+                    )
+                self._configs[key] = config
+        return config
+
+    def invalidate(self, name):
+        """Forgets a cache the API no longer accepts; the next request creates a new one."""
+        with self._lock:
+            if self._name == name:
+                log(f"Context cache {name} is gone, recreating it on the next request", level="warning")
+                self._name = None
+
+    def _ensure(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._name and now < self._expires - RENEW_MARGIN:
+                return self._name
+
+            if self._name and now < self._expires:
+                try:
+                    self._client.caches.update(
+                        name=self._name,
+                        config=types.UpdateCachedContentConfig(ttl=f"{self._ttl}s")
+                    )
+                    self._expires = now + self._ttl
+                    return self._name
+                except Exception as e:
+                    log(f"Failed to renew context cache {self._name}: {e}", level="error")
+                    self._name = None
+
+            if now < self._retry_at:
+                return None
+            try:
+                cache = self._client.caches.create(
+                    model=self._model,
+                    config=types.CreateCachedContentConfig(
+                        display_name="system-instruction-and-tools",
+                        system_instruction=self._system_instruction,
+                        tools=self._tools,
+                        ttl=f"{self._ttl}s",
+                    )
+                )
+            except Exception as e:
+                log(f"Context caching unavailable, sending the prompt inline: {e}", level="warning")
+                self._retry_at = now + self._retry_after
+                return None
+            # Configs of caches that are gone would otherwise pile up
+            self._configs = {key: config for key, config in self._configs.items() if key[0] is None}
+            self._name = cache.name
+            self._expires = now + self._ttl
+            log(f"Created context cache {cache.name} (ttl {self._ttl}s)")
+            return self._name
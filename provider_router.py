@@ -0,0 +1,231 @@
+"""
+Provider Router
+Sends each reply to the preferred LLM provider and, when that takes longer
+than it usually does, to a fallback provider as well, using whichever answer
+comes first ("hedging"). A provider that keeps failing is skipped for a
+while by a circuit breaker, and a failed call fails over right away.
+"""
+
+import time
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import metrics
+from tracing import log
+
+WINDOW = 100  # recent calls per provider used for latency and error rate
+MIN_SAMPLES = 20  # successful calls needed before the hedge delay follows measured latency
+HEDGE_PERCENTILE = 0.95
+
+
+class ProviderStats:
+    """Rolling latency and error rate of one provider, and its circuit breaker.
+
+    The breaker opens after `failure_threshold` failures in a row and stays
+    open for `cooldown` seconds; then one trial call is let through, which
+    closes it again on success.
+    """
+
+    def __init__(self, name, failure_threshold=5, cooldown=60):
+        self.name = name
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=WINDOW)  # successful calls only
+        self._results = deque(maxlen=WINDOW)  # True for success
+        self._failures = 0  # in a row
+        self._open_until = 0.0
+        self._probing = False
+
+    def available(self) -> bool:
+        """False while the breaker is open, or while its trial call is running."""
+        with self._lock:
+            if self._failures < self._failure_threshold:
+                return True
+            return not self._probing and time.monotonic() >= self._open_until
+
+    def start(self):
+        """Called right before a call; if the breaker was open this is its trial call."""
+        with self._lock:
+            if self._failures >= self._failure_threshold:
+                self._probing = True
+
+    def record(self, seconds, ok):
+        with self._lock:
+            self._probing = False
+            self._results.append(ok)
+            if ok:
+                self._latencies.append(seconds)
+                if self._failures >= self._failure_threshold:
+                    log(f"{self.name} is answering again, closing its circuit breaker")
+                self._failures = 0
+            else:
+                self._failures += 1
+                if self._failures >= self._failure_threshold:
+                    if self._failures == self._failure_threshold:
+                        log(f"{self.name} failed {self._failures} times in a row, skipping it for {self._cooldown}s", level="warning")
+                    self._open_until = time.monotonic() + self._cooldown
+            error_rate = 1 - sum(self._results) / len(self._results)
+            open_ = self._failures >= self._failure_threshold
+        metrics.inc("llm_calls_total", provider=self.name, result="ok" if ok else "error")
+        metrics.observe("llm_call_seconds", seconds, provider=self.name)
+        metrics.set_gauge("llm_error_rate", error_rate, provider=self.name)
+        metrics.set_gauge("llm_breaker_open", int(open_), provider=self.name)
+
+    def abandon(self):
+        """A call was cancelled before it finished; it says nothing about the provider."""
+        with self._lock:
+            self._probing = False
+
+    def hedge_delay(self, default) -> float:
+        """Seconds to wait before hedging: this provider's p95 latency, at most `default`."""
+        with self._lock:
+            if len(self._latencies) < MIN_SAMPLES:
+                return default
+            latencies = sorted(self._latencies)
+        return min(default, latencies[int(HEDGE_PERCENTILE * (len(latencies) - 1))])
+
+
+class ProviderRouter:
+    """Routes calls over `order` (provider names, preferred first).
+
+    `call()` takes {provider: zero-argument callable} and returns the first
+    successful result. The fallback is started when the first provider fails,
+    or when it hasn't answered within its hedge delay (`hedge_after` seconds
+    at most; 0 turns hedging off). The loser of a hedge is cancelled where
+    possible; on the thread engine it runs to the end and is ignored.
+    """
+
+    def __init__(self, order, hedge_after=10, failure_threshold=5, cooldown=60, workers=8):
+        self.order = list(order)
+        self._hedge_after = hedge_after
+        self.stats = {name: ProviderStats(name, failure_threshold, cooldown) for name in self.order}
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="llm") if len(self.order) > 1 else None
+
+    def plan(self) -> list:
+        """Providers for the next call, preferred first; ones with an open breaker are left out."""
+        healthy = [name for name in self.order if self.stats[name].available()]
+        # Everything is failing: keep trying the preferred provider rather than nothing
+        return healthy or self.order[:1]
+
+    def call(self, calls: dict):
+        plan = [name for name in self.plan() if name in calls]
+        if len(plan) == 1:
+            return self._timed(plan[0], calls[plan[0]])
+
+        primary, fallbacks = plan[0], plan[1:]
+        futures = {self._submit(primary, calls[primary]): primary}
+        hedge_at = self._hedge_delay(primary)
+        hedged, error = False, None
+        while futures:
+            timeout = hedge_at if fallbacks and hedge_at else None
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                name = self._hedge(primary, fallbacks, hedge_at)
+                futures[self._submit(name, calls[name])] = name
+                hedge_at, hedged = None, True
+                continue
+            for future in done:
+                name = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = error or e
+                    if fallbacks and not futures:
+                        name = self._failover(name, fallbacks, e)
+                        futures[self._submit(name, calls[name])] = name
+                    continue
+                for loser in futures:
+                    loser.cancel()
+                self._won(primary, name, hedged)
+                return result
+        raise error
+
+    async def call_async(self, calls: dict):
+        """`call` for the async engine; the callables return coroutines, and losers are cancelled."""
+        plan = [name for name in self.plan() if name in calls]
+        if len(plan) == 1:
+            return await self._timed_async(plan[0], calls[plan[0]])
+
+        primary, fallbacks = plan[0], plan[1:]
+        tasks = {asyncio.create_task(self._timed_async(primary, calls[primary])): primary}
+        hedge_at = self._hedge_delay(primary)
+        hedged, error = False, None
+        try:
+            while tasks:
+                timeout = hedge_at if fallbacks and hedge_at else None
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    name = self._hedge(primary, fallbacks, hedge_at)
+                    tasks[asyncio.create_task(self._timed_async(name, calls[name]))] = name
+                    hedge_at, hedged = None, True
+                    continue
+                for task in done:
+                    name = tasks.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        error = error or e
+                        if fallbacks and not tasks:
+                            name = self._failover(name, fallbacks, e)
+                            tasks[asyncio.create_task(self._timed_async(name, calls[name]))] = name
+                        continue
+                    self._won(primary, name, hedged)
+                    return result
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _submit(self, name, fn):
+        # Run in the caller's context, so the call shows up in its trace
+        return self._executor.submit(contextvars.copy_context().run, self._timed, name, fn)
+
+    def _hedge_delay(self, primary):
+        return self.stats[primary].hedge_delay(self._hedge_after) if self._hedge_after else None
+
+    def _hedge(self, primary, fallbacks, waited):
+        name = fallbacks.pop(0)
+        log(f"{primary} hasn't answered after {waited:.1f}s, also asking {name}", level="warning")
+        metrics.inc("llm_hedges_total", provider=name)
+        return name
+
+    def _failover(self, failed, fallbacks, error):
+        name = fallbacks.pop(0)
+        log(f"{failed} failed ({error}), trying {name}", level="warning")
+        metrics.inc("llm_failovers_total", provider=name)
+        return name
+
+    def _won(self, primary, name, hedged):
+        if hedged and name != primary:
+            metrics.inc("llm_hedge_wins_total", provider=name)
+
+    def _timed(self, name, fn):
+        stats = self.stats[name]
+        stats.start()
+        started = time.monotonic()
+        try:
+            result = fn()
+        except Exception:
+            stats.record(time.monotonic() - started, ok=False)
+            raise
+        stats.record(time.monotonic() - started, ok=True)
+        return result
+
+    async def _timed_async(self, name, fn):
+        stats = self.stats[name]
+        stats.start()
+        started = time.monotonic()
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            stats.abandon()
+            raise
+        except Exception:
+            stats.record(time.monotonic() - started, ok=False)
+            raise
+        stats.record(time.monotonic() - started, ok=True)
+        return result
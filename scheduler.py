@@ -0,0 +1,199 @@
+"""
+Scheduler
+Token buckets that track how much quota each backend has left, so calls wait
+for quota instead of failing and backing off after the fact. The Mastodon
+bucket follows the X-RateLimit-* headers of every response; LLM buckets are
+sized from configured requests and tokens per minute.
+"""
+
+import re
+import time
+import asyncio
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime
+
+import metrics
+from tracing import log
+
+_background = contextvars.ContextVar("background", default=False)
+_RETRY_DELAY = re.compile(r"retryDelay['\"]?\s*:\s*['\"]?(\d+(?:\.\d+)?)s")
+
+
+@contextmanager
+def background():
+    """Marks calls made in this block as deferrable: they leave a reserve of quota for replies."""
+    token = _background.set(True)
+    try:
+        yield
+    finally:
+        _background.reset(token)
+
+
+def retry_after(error, default=60.0) -> float:
+    """Seconds a provider asked us to wait in a 429 error (Retry-After header or Gemini's retryDelay)."""
+    response = getattr(error, "response", None)
+    value = getattr(response, "headers", {}).get("retry-after", "") if response is not None else ""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    match = _RETRY_DELAY.search(str(getattr(error, "details", "")) or str(error))
+    return float(match.group(1)) if match else default
+
+
+class TokenBucket:
+    """`capacity` tokens refilled continuously at `rate` per second.
+
+    When the server tells us when its window resets (`reset_at`), continuous
+    refill is suspended and the bucket fills up at that moment instead.
+    Not locked; RateLimiter serializes access.
+    """
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = float(capacity)
+        self.reset_at = None  # monotonic time at which the server's window resets
+        self._updated = time.monotonic()
+
+    def refill(self, now):
+        if self.reset_at is not None:
+            if now >= self.reset_at:
+                self.tokens, self.reset_at = float(self.capacity), None
+        else:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount, now) -> float:
+        """Seconds until `amount` tokens are available (0 if they are now)."""
+        amount = min(amount, self.capacity)  # a request larger than the bucket waits for a full one
+        if self.tokens >= amount:
+            return 0.0
+        if self.reset_at is not None:
+            return max(0.0, self.reset_at - now)
+        return (amount - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+
+class RateLimiter:
+    """Quota of one backend: requests per `window` seconds, plus optionally tokens.
+
+    `acquire()` blocks until the call fits. Calls made inside `background()`
+    additionally leave `reserve` (a fraction of each bucket) untouched, so
+    optional work such as tool lookups backs off before replies do. A limit
+    of 0 means unlimited.
+    """
+
+    def __init__(self, name, requests=0, window=60, tokens=0, reserve=0.1):
+        self.name = name
+        self.reserve = reserve
+        self._lock = threading.Lock()
+        self._requests = TokenBucket(requests, requests / window) if requests else None
+        self._tokens = TokenBucket(tokens, tokens / window) if tokens else None
+        self._publish()
+
+    def acquire(self, tokens=0):
+        """Blocks until a request of `tokens` tokens fits in the quota, then takes it."""
+        waited = 0.0
+        while (wait := self._try_take(tokens)) > 0:
+            self._holding(wait, waited)
+            time.sleep(wait)
+            waited += wait
+
+    async def acquire_async(self, tokens=0):
+        """`acquire` for the async engine."""
+        waited = 0.0
+        while (wait := self._try_take(tokens)) > 0:
+            self._holding(wait, waited)
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def wait_time(self) -> float:
+        """Seconds until a single request would be allowed."""
+        with self._lock:
+            return self._wait(0, time.monotonic(), reserve=0)
+
+    def observe_headers(self, headers):
+        """Syncs the request bucket with a response's X-RateLimit-* headers."""
+        if self._requests is None or "X-RateLimit-Remaining" not in headers:
+            return
+        try:
+            remaining = int(headers["X-RateLimit-Remaining"])
+            limit = int(headers.get("X-RateLimit-Limit", self._requests.capacity))
+            reset = headers.get("X-RateLimit-Reset")
+            reset_in = _seconds_until(reset) if reset else None
+        except ValueError:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._requests.refill(now)
+            self._requests.capacity = limit
+            self._requests.tokens = float(remaining)
+            if reset_in is not None:
+                self._requests.reset_at = now + max(0.0, reset_in)
+        self._publish()
+
+    def hold(self, seconds):
+        """Stops all calls for `seconds`, e.g. after the provider answered 429 anyway."""
+        log(f"{self.name} rate limited, holding calls for {seconds:.0f}s", level="warning")
+        metrics.inc("quota_holds_total", backend=self.name)
+        with self._lock:
+            reset_at = time.monotonic() + seconds
+            for bucket in (self._requests, self._tokens):
+                if bucket is not None:
+                    bucket.tokens, bucket.reset_at = 0.0, reset_at
+        self._publish()
+
+    def settle(self, estimated, used):
+        """Corrects the token bucket once a response reports how many tokens were really used."""
+        if self._tokens is None or used is None:
+            return
+        with self._lock:
+            bucket = self._tokens
+            bucket.refill(time.monotonic())
+            bucket.tokens = min(bucket.capacity, bucket.tokens + estimated - used)
+        self._publish()
+
+    def _try_take(self, tokens) -> float:
+        reserve = self.reserve if _background.get() else 0
+        with self._lock:
+            now = time.monotonic()
+            wait = self._wait(tokens, now, reserve)
+            if wait == 0:
+                if self._requests is not None:
+                    self._requests.tokens -= 1
+                if self._tokens is not None:
+                    self._tokens.tokens -= tokens
+        self._publish()
+        return wait
+
+    def _wait(self, tokens, now, reserve) -> float:
+        wait = 0.0
+        for bucket, amount in ((self._requests, 1), (self._tokens, tokens)):
+            if bucket is not None:
+                bucket.refill(now)
+                wait = max(wait, bucket.wait_time(amount + reserve * bucket.capacity, now))
+        return wait
+
+    def _holding(self, wait, waited):
+        if not waited and wait >= 1:
+            log(f"{self.name} quota low, holding a call for {wait:.1f}s", level="warning")
+        metrics.inc("quota_wait_seconds_total", wait, backend=self.name)
+
+    def _publish(self):
+        headroom = 1.0
+        with self._lock:
+            for kind, bucket in (("requests", self._requests), ("tokens", self._tokens)):
+                if bucket is not None:
+                    metrics.set_gauge("quota_remaining", max(0.0, bucket.tokens), backend=self.name, kind=kind)
+                    headroom = min(headroom, max(0.0, bucket.tokens) / bucket.capacity)
+        metrics.set_gauge("quota_headroom", headroom, backend=self.name)
+
+
+def _seconds_until(reset) -> float:
+    """X-RateLimit-Reset is an ISO 8601 time on Mastodon, a Unix timestamp on some forks."""
+    try:
+        return float(reset) - time.time()
+    except ValueError:
+        return datetime.fromisoformat(reset).timestamp() - time.time()
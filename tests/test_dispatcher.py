@@ -0,0 +1,57 @@
+import time
+import unittest
+import threading
+
+from dispatcher import MentionDispatcher
+
+
+class ShedMentionTest(unittest.TestCase):
+    """A shed mention holds the cursor back only until it is known to be gone or too old."""
+
+    def setUp(self):
+        self.commits = []
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def shed(self, drop_ttl=900):
+        # One worker stuck on mention 1 and room for two: mention 3 pushes out mention 2
+        dispatcher = MentionDispatcher(lambda items: self.release.wait(5), workers=1, max_pending=2,
+                                       on_commit=self.commits.append, drop_ttl=drop_ttl)
+        for note_id in (1, 2, 3):
+            dispatcher.submit(note_id, f"thread-{note_id}", note_id, f"account-{note_id}")
+        self.assertEqual(dispatcher.dropped_ids(), {2})
+        self.release.set()
+        wait_for(lambda: dispatcher.pending() == 0)
+        self.assertEqual(self.commits, [1])  # never past the shed mention
+        return dispatcher
+
+    def test_resubmitted_mention_is_handled(self):
+        dispatcher = self.shed()
+        self.assertTrue(dispatcher.submit(2, "thread-2", 2, "account-2"))
+        wait_for(lambda: self.commits[-1] == 3)
+        self.assertEqual(dispatcher.dropped(), 0)
+
+    def test_mention_missing_from_poll_is_released(self):
+        dispatcher = self.shed()
+        dispatcher.forget_dropped({2})
+        self.assertEqual(self.commits[-1], 3)
+        self.assertEqual(dispatcher.dropped(), 0)
+
+    def test_old_mention_is_released(self):
+        dispatcher = self.shed(drop_ttl=0.2)
+        self.assertEqual(dispatcher.dropped(), 1)
+        time.sleep(0.3)
+        self.assertEqual(dispatcher.dropped(), 0)
+        self.assertEqual(self.commits[-1], 3)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+if __name__ == "__main__":
+    unittest.main()
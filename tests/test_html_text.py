@@ -0,0 +1,27 @@
+import unittest
+
+from html_text import html_to_text
+
+
+class BotMentionTest(unittest.TestCase):
+    """Mentions of the bot are removed; other names that start the same way are not."""
+
+    def strip(self, html):
+        return html_to_text(html, bot_acct="clod@example.social", collapse_whitespace=True)
+
+    def test_mention_at_end_of_sentence(self):
+        self.assertEqual(self.strip("<p>thanks @clod.</p>"), "thanks .")
+        self.assertEqual(self.strip("<p>thanks @clod. see you</p>"), "thanks . see you")
+        self.assertEqual(self.strip("<p>ask @clod@example.social.</p>"), "ask .")
+
+    def test_mention_followed_by_space(self):
+        self.assertEqual(self.strip("<p>@clod hi</p>"), "hi")
+
+    def test_other_accounts_are_kept(self):
+        self.assertEqual(self.strip("<p>@clodette hi</p>"), "@clodette hi")
+        self.assertEqual(self.strip("<p>@clod.fan hi</p>"), "@clod.fan hi")
+        self.assertEqual(self.strip("<p>@clod@other.social hi</p>"), "@clod@other.social hi")
+
+
+if __name__ == "__main__":
+    unittest.main()
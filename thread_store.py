@@ -0,0 +1,165 @@
+"""
+Thread Store
+Caches Mastodon thread context per conversation root and grows it
+incrementally as new statuses in the thread are seen.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+import metrics
+
+
+def _sid(status_id):
+    # Mastodon.py hands out IDs as int or str depending on version; compare them as strings
+    return str(status_id) if status_id is not None else None
+
+
+def _order(status_id):
+    # Numeric IDs sort correctly by length first, then lexically
+    return len(status_id), status_id
+
+
+class ThreadStore:
+    """Serves ancestors/descendants of a status without refetching the whole thread.
+
+    Each thread is stored under the ID of its root post. Statuses we see later
+    (new mentions, our own replies) are added with `add`, and a full
+    `status_context` fetch only happens when a status' ancestor chain is not
+    fully known or the thread entry is older than `ttl` seconds.
+    """
+
+    def __init__(self, fetch_context, ttl=600, max_threads=256):
+        self._fetch_context = fetch_context
+        self._ttl = ttl
+        self._max_threads = max_threads
+        self._lock = threading.Lock()
+        self._threads = OrderedDict()  # root id -> {"statuses", "parents", "anchors", "fetched_at"}
+        self._roots = {}  # status id -> root id
+
+    def add(self, status) -> bool:
+        """Adds a newly seen status to its thread. Returns False if the thread isn't cached."""
+        sid = _sid(status.id)
+        parent = _sid(getattr(status, "in_reply_to_id", None))
+        with self._lock:
+            root = self._roots.get(sid) or (self._roots.get(parent) if parent else None)
+            thread = self._threads.get(root)
+            if thread is None:
+                return False
+            thread["statuses"][sid] = status
+            thread["parents"][sid] = parent
+            self._roots[sid] = root
+            return True
+
+    def ancestors(self, status) -> list:
+        """Returns the statuses above `status` in its thread, oldest first."""
+        self.add(status)
+        sid = _sid(status.id)
+        with self._lock:
+            chain = self._chain(sid)
+        metrics.inc("thread_store_requests_total", result="miss" if chain is None else "hit")
+        if chain is None:
+            self._refresh(sid, status)
+            with self._lock:
+                chain = self._chain(sid) or []
+        return chain
+
+    def context(self, status_id) -> dict:
+        """Returns {"ancestors": [...], "descendants": [...]} for a status ID."""
+        status_id = _sid(status_id)
+        with self._lock:
+            chain = self._chain(status_id)
+            if chain is not None and not self._has_all_replies(status_id, chain):
+                chain = None
+            descendants = self._descendants(status_id) if chain is not None else None
+        metrics.inc("thread_store_requests_total", result="miss" if chain is None else "hit")
+        if chain is None:
+            self._refresh(status_id)
+            with self._lock:
+                chain = self._chain(status_id) or []
+                descendants = self._descendants(status_id)
+        return {"ancestors": chain, "descendants": descendants}
+
+    def _refresh(self, status_id, status=None):
+        context = self._fetch_context(status_id)
+        ancestors = list(context["ancestors"])
+        descendants = list(context["descendants"])
+        root = _sid(ancestors[0].id) if ancestors else status_id
+
+        statuses = {_sid(s.id): s for s in ancestors + descendants}
+        parents = {_sid(s.id): _sid(getattr(s, "in_reply_to_id", None)) for s in ancestors + descendants}
+        # The context doesn't include the status itself, so link it up by hand
+        parents[status_id] = _sid(ancestors[-1].id) if ancestors else None
+        if status is not None:
+            statuses[status_id] = status
+
+        with self._lock:
+            # Merge rather than replace so branches fetched earlier are kept
+            thread = self._threads.setdefault(root, {"statuses": {}, "parents": {}, "anchors": set()})
+            thread["statuses"].update(statuses)
+            thread["parents"].update(parents)
+            thread["anchors"].add(status_id)
+            thread["fetched_at"] = time.monotonic()
+            self._threads.move_to_end(root)
+            for sid in parents:
+                self._roots[sid] = root
+            while len(self._threads) > self._max_threads:
+                self._drop(next(iter(self._threads)))
+
+    def _drop(self, root):
+        thread = self._threads.pop(root, None)
+        if thread:
+            for sid in thread["parents"]:
+                if self._roots.get(sid) == root:
+                    del self._roots[sid]
+
+    def _fresh_thread(self, status_id):
+        root = self._roots.get(status_id)
+        thread = self._threads.get(root)
+        if thread is None or time.monotonic() - thread["fetched_at"] > self._ttl:
+            return None
+        self._threads.move_to_end(root)
+        return thread
+
+    def _chain(self, status_id):
+        """Walks parent links up to the root. Returns None if any link is missing or stale."""
+        thread = self._fresh_thread(status_id)
+        if thread is None or status_id not in thread["parents"]:
+            return None
+        chain = []
+        parent = thread["parents"][status_id]
+        while parent is not None:
+            if parent not in thread["statuses"] or len(chain) > len(thread["parents"]):
+                return None
+            chain.append(thread["statuses"][parent])
+            parent = thread["parents"].get(parent)
+        chain.reverse()
+        return chain
+
+    def _has_all_replies(self, status_id, chain):
+        """True if a fetch has covered every reply below this status.
+
+        status_context returns the full subtree below the fetched status, so the
+        replies are complete if the status or one of its ancestors was fetched.
+        """
+        anchors = self._threads[self._roots[status_id]]["anchors"]
+        return status_id in anchors or any(_sid(s.id) in anchors for s in chain)
+
+    def _descendants(self, status_id):
+        """Returns known replies below a status, depth first like status_context."""
+        thread = self._threads.get(self._roots.get(status_id))
+        if thread is None:
+            return []
+        children = {}
+        for sid, parent in thread["parents"].items():
+            if parent is not None and sid in thread["statuses"]:
+                children.setdefault(parent, []).append(sid)
+
+        result = []
+        stack = sorted(children.get(status_id, []), key=_order, reverse=True)
+        while stack:
+            sid = stack.pop()
+            result.append(thread["statuses"][sid])
+            stack.extend(sorted(children.get(sid, []), key=_order, reverse=True))
+        return result
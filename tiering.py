@@ -0,0 +1,90 @@
+"""
+Tiering
+Picks how much each new reply may cost. Under load (a long mention queue or
+slow replies) new replies move down to a faster model, fewer output tokens
+and fewer tool rounds; once things calm down they move back up, one tier
+at a time.
+"""
+
+import time
+import threading
+from collections import deque
+from typing import NamedTuple
+
+import metrics
+from tracing import log
+
+LATENCY_WINDOW = 300  # seconds of reply latencies considered
+LATENCY_SAMPLES = 50
+
+
+class Tier(NamedTuple):
+    """Limits for one reply."""
+    name: str
+    gemini_model: str
+    openai_model: str
+    max_tokens: int | None  # None leaves output uncapped
+    max_tool_rounds: int  # 0 means the model gets no tools
+
+
+class TierPolicy:
+    """Moves between `tiers` (most capable first) based on load.
+
+    Under pressure (`queue_depth()`, the mentions waiting for a free worker,
+    at least `queue_pressure`, or median reply latency at least
+    `latency_pressure` seconds) it steps down one tier; when both are under
+    half of that (a quarter for the queue) it steps back up. It stays in a
+    tier for at least `dwell` seconds either way, so a single burst doesn't
+    make it flap. `queue_depth` may be set once the dispatcher exists; until
+    then only latency counts.
+    """
+
+    def __init__(self, tiers, queue_depth=None, queue_pressure=20, latency_pressure=20.0, dwell=60):
+        self.tiers = list(tiers)
+        self.queue_depth = queue_depth
+        self._queue_pressure = queue_pressure
+        self._latency_pressure = latency_pressure
+        self._dwell = dwell
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)  # (finished at, seconds)
+        self._level = 0
+        self._since = time.monotonic()
+        self._accounted = self._since
+        metrics.set_gauge("llm_tier", 0)
+
+    def record(self, seconds):
+        """Reports how long a reply took."""
+        with self._lock:
+            self._latencies.append((time.monotonic(), seconds))
+
+    def current(self) -> Tier:
+        """The tier for a reply starting now."""
+        depth = self.queue_depth() if self.queue_depth else 0
+        with self._lock:
+            now = time.monotonic()
+            self._account(now)
+            latency = self._median_latency(now)
+            if now - self._since >= self._dwell:
+                if depth >= self._queue_pressure or latency >= self._latency_pressure:
+                    self._move(self._level + 1, now, depth, latency)
+                elif depth <= self._queue_pressure / 4 and latency < self._latency_pressure / 2:
+                    self._move(self._level - 1, now, depth, latency)
+            return self.tiers[self._level]
+
+    def _median_latency(self, now) -> float:
+        recent = sorted(seconds for finished, seconds in self._latencies if now - finished <= LATENCY_WINDOW)
+        return recent[len(recent) // 2] if recent else 0.0
+
+    def _move(self, level, now, depth, latency):
+        level = max(0, min(len(self.tiers) - 1, level))
+        if level == self._level:
+            return
+        old, new = self.tiers[self._level].name, self.tiers[level].name
+        log(f"Reply tier {old} -> {new} (queue {depth}, median reply {latency:.1f}s)")
+        metrics.inc("llm_tier_changes_total", from_tier=old, to_tier=new)
+        metrics.set_gauge("llm_tier", level)
+        self._level, self._since = level, now
+
+    def _account(self, now):
+        metrics.inc("llm_tier_seconds_total", now - self._accounted, tier=self.tiers[self._level].name)
+        self._accounted = now
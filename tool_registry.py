@@ -0,0 +1,134 @@
+"""
+Tool Registry
+One definition per tool the model can call. The OpenAI and Gemini schemas
+are generated from it once at startup, and every call goes through one
+place that handles dispatch, caching and timing.
+"""
+
+import json
+import time
+import asyncio
+from typing import Callable, NamedTuple, Optional
+
+from google.genai import types
+
+import metrics
+
+
+class Tool(NamedTuple):
+    """A callable tool and how it may be run."""
+    name: str
+    handler: Callable  # (**args) -> dict, blocking
+    description: str
+    parameters: dict  # JSON schema of the arguments
+    timeout: float  # seconds before the call is abandoned
+    cache_ttl: Optional[int] = None  # seconds a result stays fresh; None means never cached
+    parallel: bool = True  # may run alongside other calls of the same model turn
+    async_handler: Optional[Callable] = None  # native coroutine version, used by the async engine
+
+
+class ToolRegistry:
+    """Holds every tool; `freeze()` builds the provider schemas once.
+
+    Results of tools with a `cache_ttl` are cached by (name, arguments) in
+    `cache`; "not found" errors are cached for `negative_ttl` seconds so
+    repeated lookups of a bad ID don't hit the API.
+    """
+
+    def __init__(self, cache, negative_ttl=60, default_timeout=15):
+        self._tools = {}
+        self._cache = cache
+        self._negative_ttl = negative_ttl
+        self._default_timeout = default_timeout
+        self.openai_schemas = None
+        self.gemini_tools = None
+
+    def register(self, name, handler, description, properties, required=(), timeout=None,
+                 cache_ttl=None, parallel=True, async_handler=None):
+        if self.openai_schemas is not None:
+            raise RuntimeError(f"Cannot register {name}: the tool registry is frozen")
+        parameters = {"type": "object", "properties": properties, "required": list(required)}
+        self._tools[name] = Tool(
+            name, handler, description, parameters,
+            timeout if timeout is not None else self._default_timeout,
+            cache_ttl, parallel, async_handler,
+        )
+
+    def freeze(self):
+        """Builds the provider schemas. Call once, after every tool is registered."""
+        tools = self._tools.values()
+        self.openai_schemas = [
+            {
+                "type": "function",
+                "function": {"name": t.name, "description": t.description, "parameters": t.parameters},
+            }
+            for t in tools
+        ]
+        self.gemini_tools = [types.Tool(function_declarations=[
+            types.FunctionDeclaration(name=t.name, description=t.description, parameters=t.parameters)
+            for t in tools
+        ])]
+
+    def get(self, name) -> Optional[Tool]:
+        return self._tools.get(name)
+
+    def timeout(self, name) -> float:
+        tool = self._tools.get(name)
+        return tool.timeout if tool else self._default_timeout
+
+    def execute(self, name: str, args: dict) -> dict:
+        """Runs a tool, serving repeat lookups from the cache."""
+        tool = self._tools.get(name)
+        if tool is None:
+            return {"error": f"Unknown function: {name}"}
+        key, result = self._cached(tool, args)
+        if result is not None:
+            return result
+        started = time.monotonic()
+        try:
+            result = tool.handler(**args)
+        finally:
+            self._timed(tool, started)
+        self._store(tool, key, result)
+        return result
+
+    async def execute_async(self, name: str, args: dict) -> dict:
+        """`execute` for the async engine; blocking handlers run on a worker thread."""
+        tool = self._tools.get(name)
+        if tool is None:
+            return {"error": f"Unknown function: {name}"}
+        key, result = self._cached(tool, args)
+        if result is not None:
+            return result
+        started = time.monotonic()
+        try:
+            if tool.async_handler is not None:
+                result = await tool.async_handler(**args)
+            else:
+                result = await asyncio.to_thread(tool.handler, **args)
+        finally:
+            self._timed(tool, started)
+        self._store(tool, key, result)
+        return result
+
+    def _cached(self, tool, args):
+        if tool.cache_ttl is None:
+            return None, None
+        key = (tool.name, json.dumps(args, sort_keys=True, default=str))
+        result = self._cache.get(key)
+        metrics.inc("tool_cache_requests_total", tool=tool.name, result="miss" if result is None else "hit")
+        return key, result
+
+    def _store(self, tool, key, result):
+        if key is None:
+            return
+        if "error" not in result:
+            self._cache.set(key, result, tool.cache_ttl)
+        elif result.get("not_found"):
+            self._cache.set(key, result, self._negative_ttl)
+
+    def _timed(self, tool, started):
+        elapsed = time.monotonic() - started
+        metrics.inc("tool_calls_total", tool=tool.name)
+        metrics.inc("tool_seconds_total", elapsed, tool=tool.name)
+        metrics.observe("tool_call_seconds", elapsed, tool=tool.name)
@@ -0,0 +1,146 @@
+"""
+Tracing
+Structured JSON logs and per-mention traces. Every log line is a JSON object
+carrying the trace and span it was written in, so all output about one
+mention can be pulled out by its trace ID. Spans (context fetch, LLM rounds,
+tool calls, the post) are written with their durations to a local trace
+file, which works without any collector running.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar("span", default=None)  # (trace_id, span_id) of the running span
+_lock = threading.Lock()
+_file = None
+_disabled = False  # set once the trace file can't be written
+
+
+@functools.cache
+def settings() -> dict:
+    """Tracing settings, read on first use; the entry point loads .env before that."""
+    return {
+        "trace_file": os.getenv("TRACE_FILE", "./traces.jsonl"),  # spans and logs as JSON lines; empty turns it off
+        "max_bytes": int(os.getenv("TRACE_FILE_MAX_BYTES", 50 * 1024 * 1024)),  # then it moves to TRACE_FILE.1
+        "log_format": os.getenv("LOG_FORMAT", "json").lower(),  # "json", or "text" for plain lines on stdout
+    }
+
+
+def _new_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def current_trace():
+    """The trace ID of the running span, or None outside a trace."""
+    span = _current.get()
+    return span[0] if span else None
+
+
+def log(message, level="info", **fields):
+    """Writes a structured log line to stdout (and the trace file), tagged with the current trace."""
+    record = {"ts": round(time.time(), 3), "level": level, "msg": message, **_context(), **fields}
+    if settings()["log_format"] == "text":
+        extra = " ".join(f"{key}={value}" for key, value in fields.items())
+        trace = f"[{record['trace_id']}] " if "trace_id" in record else ""
+        print(f"{trace}{message}{' ' + extra if extra else ''}", flush=True)
+    else:
+        print(_dumps(record), flush=True)
+    _write(dict(record, type="log"))
+
+
+@contextmanager
+def trace(name, **attrs):
+    """Starts a new trace with `name` as its root span."""
+    token = _current.set(None)
+    try:
+        with span(name, **attrs) as fields:
+            yield fields
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def span(name, **attrs):
+    """Times the block as a child of the current span (or as a new trace outside one).
+
+    Yields a dict; anything put in it is written with the span, e.g. the
+    token count once the call has returned.
+    """
+    parent = _current.get()
+    trace_id = parent[0] if parent else _new_id()
+    span_id = _new_id()
+    token = _current.set((trace_id, span_id))
+    fields = dict(attrs)
+    started, wall = time.monotonic(), time.time()
+    status = "ok"
+    try:
+        yield fields
+    except BaseException as e:
+        status = "cancelled" if isinstance(e, asyncio.CancelledError) else "error"
+        fields.setdefault("error", str(e) or type(e).__name__)
+        raise
+    finally:
+        _current.reset(token)
+        _write({
+            "type": "span",
+            "ts": round(wall, 3),
+            "trace_id": trace_id,
+            "span_id": span_id,
+            "parent_id": parent[1] if parent else None,
+            "name": name,
+            "duration_ms": round((time.monotonic() - started) * 1000, 1),
+            "status": status,
+            **fields,
+        })
+
+
+def _context() -> dict:
+    span = _current.get()
+    return {"trace_id": span[0], "span_id": span[1]} if span else {}
+
+
+def _dumps(record) -> str:
+    return json.dumps(record, default=str, ensure_ascii=False)
+
+
+def _write(record):
+    global _file
+    path, max_bytes = settings()["trace_file"], settings()["max_bytes"]
+    if not path or _disabled:
+        return
+    line = _dumps(record) + "\n"
+    with _lock:
+        if _disabled:
+            return
+        try:
+            if _file is None:
+                _file = open(path, "a", encoding="utf-8")
+            if max_bytes and _file.tell() + len(line) > max_bytes:
+                _file.close()
+                os.replace(path, path + ".1")
+                _file = open(path, "a", encoding="utf-8")
+            _file.write(line)
+            _file.flush()
+        except OSError as e:
+            # Keep the bot running; the same error would repeat on every line
+            print(f"Could not write to trace file {path}, tracing to it is off: {e}", file=sys.stderr)
+            _disable()
+
+
+def _disable():
+    global _disabled, _file
+    _disabled = True
+    if _file is not None:
+        try:
+            _file.close()
+        except OSError:
+            pass
+        _file = None